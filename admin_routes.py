@@ -1,9 +1,10 @@
 # admin_routes.py
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
 from models import db, Admin, User, Subscription, Invoice
 from tasks import process_billing_cycle
+from usage_rollup import usage_series
 
 admin_bp = Blueprint('admin_bp', __name__, url_prefix='/admin')
 
@@ -152,6 +153,30 @@ def mark_invoice_paid(invoice_id):
     return redirect(url_for('admin_bp.admin_dashboard'))
 
 
+# ----------------------------
+# Usage Report API (JSON)
+# ----------------------------
+@admin_bp.route('/api/usage/<int:subscription_id>')
+def usage_report(subscription_id):
+    if session.get('role') != 'Admin':
+        return jsonify({"error": "Unauthorized"}), 401
+
+    granularity = request.args.get('granularity', 'daily')
+    days = request.args.get('days', 30, type=int)
+    end = datetime.utcnow()
+    start = end - timedelta(days=days)
+
+    series = usage_series(subscription_id, start, end, granularity)
+    return jsonify({
+        "subscription_id": subscription_id,
+        "granularity": granularity,
+        "usage": [
+            {"bucket": bucket.isoformat(), "rx_bytes": rx, "tx_bytes": tx}
+            for bucket, rx, tx in series
+        ],
+    })
+
+
 # ----------------------------
 # Dashboard Data API (JSON)
 # ----------------------------
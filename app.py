@@ -3,12 +3,16 @@ from flask import Flask, render_template, request, redirect, url_for, flash, ses
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from extensions import DATABASE_URL
 from models import db, User, Admin, Transaction, Plan, Subscription, Invoice
 from admin_routes import admin_bp
 from tasks import process_billing_cycle
-from radius_integration import grant_wifi_access
+from callback_worker import enqueue_callback
 from mpesa_clients import MpesaClient
+from usage_ingest import ingest_usage, UsageIngestError
 from flask import jsonify, request
+import os
+import hmac
 import smtplib
 from email.mime.text import MIMEText
 
@@ -18,7 +22,7 @@ app = Flask(__name__)
 # Basic Configuration
 # ----------------------------
 app.secret_key = "supersecretkey"  # change in production
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///wifinite.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL  # shared with schedular.py
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db.init_app(app)
@@ -284,6 +288,9 @@ def initiate_payment():
         plan_id=plan.id
     )
     db.session.add(transaction)
+    db.session.flush()
+    # stored before the push, so a callback for it always finds the reference
+    transaction.account_reference = f"SUB{transaction.id}"
     db.session.commit()
 
     print(f"📲 Sending STK push to {phone} for Ksh {amount}, transaction ID: {transaction.id}")
@@ -291,7 +298,10 @@ def initiate_payment():
     # Initialize M-PESA client and send STK push
     mpesa = MpesaClient()
     try:
-        mpesa.stk_push(phone, amount, transaction.id)
+        response = mpesa.stk_push(phone, amount, transaction.id, transaction.account_reference)
+        transaction.merchant_request_id = response.get("MerchantRequestID")
+        transaction.checkout_request_id = response.get("CheckoutRequestID")
+        db.session.commit()
         flash(f"📲 STK push sent for '{plan.name}' (Ksh {amount}). Check your phone.", "success")
     except Exception as e:
         print("M-PESA ERROR:", e)
@@ -302,31 +312,35 @@ def initiate_payment():
 
 @app.route('/callback', methods=['POST'])
 def mpesa_callback():
-    data = request.get_json()
-    print("📩 Callback received:", data)
-
-    stk_data = data.get('Body', {}).get('stkCallback', {})
-    if stk_data.get('ResultCode') == 0:
-        metadata = stk_data['CallbackMetadata']['Item']
-        phone = next((i['Value'] for i in metadata if i['Name'] == 'PhoneNumber'), None)
-        amount = next((i['Value'] for i in metadata if i['Name'] == 'Amount'), None)
-        receipt = next((i['Value'] for i in metadata if i['Name'] == 'MpesaReceiptNumber'), None)
-
-        txn = Transaction.query.filter_by(phone=phone, status='Pending').order_by(Transaction.timestamp.desc()).first()
-        if txn:
-            txn.status = 'Completed'
-            txn.mpesa_receipt = receipt
-            txn.raw_callback = str(data)
-            db.session.commit()
+    # Store the raw payload and acknowledge straight away; callback_worker applies
+    # the transaction update and RADIUS grant asynchronously.
+    raw_body = request.get_data(as_text=True)
+    event = enqueue_callback(raw_body)
+    print(f"📩 Callback received, queued as event {event.id}")
+    return "OK"
 
-        if phone:
-            grant_wifi_access(username=str(phone))
-            print(f"✅ WiFi access granted for {phone}")
+# ----------------------------
+# Bulk Usage Ingestion (routers / accounting collectors)
+# ----------------------------
+@app.route('/api/usage/bulk', methods=['POST'])
+def ingest_usage_bulk():
+    token = os.getenv('USAGE_INGEST_TOKEN')
+    # constant-time compare so the token can't be guessed from response timing
+    given = request.headers.get('X-Ingest-Token', '')
+    if not token or not hmac.compare_digest(given.encode(), token.encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json(silent=True)
+    rows = data.get('rows') if isinstance(data, dict) else data
+    if not isinstance(rows, list):
+        return jsonify({"error": "Expected a JSON list of usage rows or {\"rows\": [...]}"}), 400
 
-    else:
-        print("❌ Payment failed or incomplete callback")
+    try:
+        inserted = ingest_usage(rows)
+    except UsageIngestError as e:
+        return jsonify({"error": str(e), "rows": e.errors[:100]}), 400
 
-    return "OK"
+    return jsonify({"inserted": inserted})
 
 # ----------------------------
 # Error Handlers
@@ -0,0 +1,170 @@
+# auto_renew.py
+import os
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import joinedload
+
+from models import db, PendingCharge, Subscription, Transaction
+from mpesa_clients import MpesaClient
+from radius_integration import RadiusBatch
+
+# concurrent STK pushes in flight
+CHARGE_WORKERS = int(os.getenv('CHARGE_WORKERS', '8'))
+# charges claimed from the queue per round
+CHARGE_BATCH_SIZE = int(os.getenv('CHARGE_BATCH_SIZE', '200'))
+MAX_CHARGE_ATTEMPTS = 3
+# first retry delay after a failed push; doubles with each attempt
+CHARGE_RETRY_DELAY = timedelta(seconds=int(os.getenv('CHARGE_RETRY_DELAY', '300')))
+# a 'sending' claim older than this is assumed to belong to a dead dispatcher and is taken over
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+mpesa = MpesaClient()
+
+
+def queue_auto_renew(sub, invoice, amount):
+    """Queue an auto-renew charge for invoice. Added to the session, not committed."""
+    charge = PendingCharge(
+        invoice=invoice,
+        subscription_id=sub.id,
+        phone=sub.user.phone,
+        amount=amount,
+        status='pending',
+        attempts=0
+    )
+    db.session.add(charge)
+    return charge
+
+
+def invoice_reference(invoice_id):
+    """AccountReference for an invoice charge; reconciliation.py matches payments on it."""
+    return f"INV{invoice_id}"
+
+
+def _push(charge_id, phone, amount, invoice_id):
+    # runs in a worker thread: network only, no database access
+    try:
+        return charge_id, mpesa.stk_push(phone, amount, invoice_id, invoice_reference(invoice_id)), None
+    except Exception as e:
+        return charge_id, None, str(e)
+
+
+def _claim(batch_size):
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    stale = db.and_(PendingCharge.status == 'sending', PendingCharge.claimed_at < now - CLAIM_TIMEOUT)
+    # abandoned claims that already used up their attempts are not sent again
+    PendingCharge.query.filter(stale, PendingCharge.attempts >= MAX_CHARGE_ATTEMPTS).update({
+        PendingCharge.status: 'failed',
+        PendingCharge.response: 'claim abandoned by dispatcher',
+    }, synchronize_session=False)
+    claimable = db.or_(
+        db.and_(PendingCharge.status == 'pending',
+                db.or_(PendingCharge.next_attempt_at.is_(None), PendingCharge.next_attempt_at <= now)),
+        stale
+    )
+    ids = [cid for (cid,) in db.session.query(PendingCharge.id)
+           .filter(claimable).order_by(PendingCharge.id).limit(batch_size)]
+    if not ids:
+        db.session.commit()
+        return []
+    # conditional update, so concurrent dispatchers never claim the same charge
+    PendingCharge.query.filter(PendingCharge.id.in_(ids), claimable).update({
+        PendingCharge.status: 'sending',
+        PendingCharge.claimed_by: token,
+        PendingCharge.claimed_at: now,
+        PendingCharge.attempts: db.func.coalesce(PendingCharge.attempts, 0) + 1,
+    }, synchronize_session=False)
+    db.session.commit()
+    return (PendingCharge.query
+            .options(joinedload(PendingCharge.invoice),
+                     joinedload(PendingCharge.subscription).joinedload(Subscription.plan))
+            .filter_by(claimed_by=token, status='sending')
+            .order_by(PendingCharge.id)
+            .all())
+
+
+def _retry_later(charge, error):
+    """Put a failed charge back with exponential backoff, or give up after MAX_CHARGE_ATTEMPTS."""
+    charge.response = error
+    if charge.attempts < MAX_CHARGE_ATTEMPTS:
+        charge.status = 'pending'
+        charge.next_attempt_at = datetime.utcnow() + CHARGE_RETRY_DELAY * 2 ** (charge.attempts - 1)
+    else:
+        charge.status = 'failed'
+    print(f"[WARN] STK push failed for {charge.phone} (attempt {charge.attempts}): {error}")
+
+
+def _record(charge, response, error, radius):
+    """Store the STK push outcome on the charge and queue the access change on radius.
+       The invoice stays open until reconciliation.py links it to the completed payment."""
+    charge.response = json.dumps(response) if response is not None else error
+    if response and response.get("ResponseCode") == "0":
+        charge.status = 'sent'
+        plan = charge.subscription.plan
+        # pending payment the callback will match on CheckoutRequestID
+        # and reconciliation will match to the invoice on account_reference
+        db.session.add(Transaction(
+            user_id=charge.subscription.user_id,
+            phone=charge.phone,
+            amount=int(charge.amount),
+            status='Pending',
+            plan_id=plan.id,
+            merchant_request_id=response.get("MerchantRequestID"),
+            checkout_request_id=response.get("CheckoutRequestID"),
+            account_reference=invoice_reference(charge.invoice_id),
+        ))
+        radius.enable(str(charge.phone))
+        print(f"[SUCCESS] Auto-renew STK push accepted for {charge.phone}")
+        return True
+
+    _retry_later(charge, charge.response)
+    return False
+
+
+def dispatch_pending_charges(max_workers=None, batch_size=None):
+    """
+    Send queued auto-renew STK pushes with a bounded thread pool.
+    Pushes run concurrently; results are written back from this thread only,
+    one commit per batch. Failed pushes are retried with backoff on a later run,
+    and charges left 'sending' by a dead dispatcher are reclaimed after
+    CLAIM_TIMEOUT. Must run inside an app context.
+    Returns {'sent': n, 'failed': n}.
+    """
+    max_workers = max_workers or CHARGE_WORKERS
+    batch_size = batch_size or CHARGE_BATCH_SIZE
+    summary = {'sent': 0, 'failed': 0}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while True:
+            charges = _claim(batch_size)
+            if not charges:
+                break
+            by_id = {charge.id: charge for charge in charges}
+            radius = RadiusBatch()
+            futures = [
+                pool.submit(_push, charge.id, charge.phone, charge.amount, charge.invoice_id)
+                for charge in charges
+            ]
+            for future in as_completed(futures):
+                charge_id, response, error = future.result()
+                charge = by_id[charge_id]
+                try:
+                    with db.session.begin_nested():
+                        ok = _record(charge, response, error, radius)
+                except Exception as e:
+                    print(f"[ERROR] Auto-renew failed for {charge.phone}: {e}")
+                    _retry_later(charge, f"{type(e).__name__}: {e}")
+                    ok = False
+                summary['sent' if ok else 'failed'] += 1
+            db.session.commit()
+            for phone, error in radius.flush().items():
+                if error:
+                    print(f"[ERROR] Failed to enable access for {phone}: {error}")
+            if len(charges) < batch_size:
+                break
+
+    print(f"[DONE] Auto-renew dispatch: {summary['sent']} sent, {summary['failed']} failed")
+    return summary
@@ -1,23 +1,184 @@
 # bandwidth_control.py
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, User, Plan, AccessChange
+
+# seconds a cached decision is trusted; a backstop for changes made outside the ORM,
+# and how late quota_remaining can be (data_used increments are not logged)
+ACCESS_CACHE_TTL = float(os.getenv('ACCESS_CACHE_TTL', '30'))
+# users kept in the cache; least recently used are evicted first
+ACCESS_CACHE_SIZE = int(os.getenv('ACCESS_CACHE_SIZE', '10000'))
+# seconds between reads of the access_change log, i.e. how stale another process's change can be
+ACCESS_SYNC_INTERVAL = float(os.getenv('ACCESS_SYNC_INTERVAL', '2'))
+# the log is re-read this far back, so changes whose transaction committed late are still seen
+ACCESS_SYNC_OVERLAP = timedelta(seconds=30)
+# access_change rows older than this are deleted by prune_access_changes
+ACCESS_CHANGE_RETENTION = timedelta(minutes=10)
+
+# quota_remaining is in GB (None = no quota); speeds in Mbps
+AccessDecision = namedtuple('AccessDecision', 'allowed quota_remaining download_speed upload_speed')
+DENIED = AccessDecision(False, 0.0, 0, 0)
+
+
+class AccessCache:
+    """Per-process TTL + LRU map of user_id -> AccessDecision. Changes committed
+       by other processes reach it through the access_change log (see sync)."""
+
+    def __init__(self, ttl=ACCESS_CACHE_TTL, max_size=ACCESS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # user_id -> (expires_at, decision)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._next_sync = 0.0
+        self._synced_at = None  # wall clock of the last sync
+        self._applied = {}  # access_change id -> created_at, for rows still inside the overlap
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def put(self, user_id, decision):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, decision)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        """Drop the given users, or everyone when called without arguments."""
+        with self._lock:
+            if not user_ids:
+                self._entries.clear()
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def sync(self):
+        """Drop users the access_change log lists as changed since the last sync.
+           Reads the log at most every ACCESS_SYNC_INTERVAL seconds, from one thread."""
+        if time.monotonic() < self._next_sync or not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sync = time.monotonic() + ACCESS_SYNC_INTERVAL
+            now = datetime.utcnow()
+            since = (self._synced_at or now) - ACCESS_SYNC_OVERLAP
+            rows = (db.session.query(AccessChange.id, AccessChange.user_id, AccessChange.created_at)
+                    .filter(AccessChange.created_at >= since)
+                    .all())
+            self._synced_at = now
+            changed = set()
+            for change_id, user_id, created_at in rows:
+                if change_id not in self._applied:
+                    self._applied[change_id] = created_at
+                    changed.add(user_id)
+            self._applied = {i: t for i, t in self._applied.items() if t >= since}
+            if None in changed:
+                self.invalidate()
+            elif changed:
+                self.invalidate(*changed)
+        finally:
+            self._sync_lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+access_cache = AccessCache()
+
+
+def _decide(is_active, data_used, data_quota, download_speed, upload_speed):
+    if data_quota is None:
+        remaining = None  # plan without a data cap
+    else:
+        remaining = max(0.0, data_quota - (data_used or 0.0))
+    if not is_active or remaining == 0.0:
+        return AccessDecision(False, remaining, 0, 0)
+    return AccessDecision(True, remaining, download_speed, upload_speed)
+
+
+def _load_decision(user_id):
+    # one joined row instead of lazy-loading user.plan
+    row = (db.session.query(User.is_active, User.data_used, Plan.data_quota,
+                            Plan.download_speed, Plan.upload_speed)
+           .join(Plan, User.plan_id == Plan.id)
+           .filter(User.id == user_id)
+           .first())
+    return _decide(*row) if row else DENIED
+
+
+def access_decision(user):
+    """Cached AccessDecision for a User (or user id)."""
+    user_id = getattr(user, 'id', user)
+    if user_id is None:
+        # not saved yet, nothing to cache under
+        if not user.plan:
+            return DENIED
+        return _decide(user.is_active, user.data_used, user.plan.data_quota,
+                       user.plan.download_speed, user.plan.upload_speed)
+    access_cache.sync()
+    decision = access_cache.get(user_id)
+    if decision is None:
+        decision = _load_decision(user_id)
+        access_cache.put(user_id, decision)
+    return decision
+
 
 def can_use_internet(user):
     """Check if the user is within their plan's quota."""
-    if not user.plan:
-        return False
-    return user.data_used < user.plan.data_quota and user.is_active
+    return access_decision(user).allowed
 
 def get_bandwidth_limits(user):
     """Return download/upload limits (in Mbps) if within quota."""
-    if can_use_internet(user):
-        return user.plan.download_speed, user.plan.upload_speed
-    else:
-        # If exceeded quota or inactive, throttle to 0 Mbps
-        return 0, 0
+    # If exceeded quota or inactive, throttle to 0 Mbps
+    decision = access_decision(user)
+    return decision.download_speed, decision.upload_speed
 
-def update_data_usage(user, mb_used, db):
-    """Increase user's data usage."""
+def update_data_usage(user, mb_used, db, commit=True):
+    """Increase user's data usage. Pass commit=False to batch several increments into one commit."""
     gb_used = mb_used / 1024  # convert MB → GB
-    user.data_used += gb_used
-    if user.data_used >= user.plan.data_quota:
+    user.data_used = (user.data_used or 0.0) + gb_used
+    if user.plan.data_quota is not None and user.data_used >= user.plan.data_quota:
         user.is_active = False  # disable internet if quota exceeded
+        access_cache.invalidate(user.id)  # quota crossed: stop serving the old decision now
+    if commit:
+        db.session.commit()
+
+
+# ---- Invalidation ----
+# models.record_access_changes logs changed users (ORM edits via a flush hook in
+# models.py) and leaves them in session.info for this process's cache
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _apply_access_invalidations(session):
+    # after a rollback too: decisions read inside the transaction may reflect rolled-back rows
+    pending = session.info.pop('access_invalidations', None)
+    if not pending:
+        return
+    if None in pending:
+        access_cache.invalidate()
+    else:
+        access_cache.invalidate(*pending)
+
+
+def prune_access_changes(now: datetime=None):
+    """Delete access_change rows every process has had time to read."""
+    now = now or datetime.utcnow()
+    removed = (AccessChange.query
+               .filter(AccessChange.created_at < now - ACCESS_CHANGE_RETENTION)
+               .delete(synchronize_session=False))
     db.session.commit()
+    return removed
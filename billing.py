@@ -1,27 +1,37 @@
 # billing.py
+import os
 import math
 import json
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal, ROUND_HALF_UP
 
-from models import db, User, Plan, Subscription, Usage, Invoice
+import numpy as np
+from sqlalchemy.orm import joinedload
+
+from models import db, User, Plan, Subscription, Usage, Invoice, BillingRun
+from billing_calendar import default_calendar
+from usage_rollup import rollup_totals
+
+# subscriptions loaded (and invoices committed) per chunk in billing runs
+BILLING_BATCH_SIZE = int(os.getenv('BILLING_BATCH_SIZE', '500'))
+# a running BillingRun without a checkpoint for this long is treated as crashed and taken over
+BILLING_RUN_LEASE = timedelta(seconds=int(os.getenv('BILLING_RUN_LEASE', '900')))
+# below this many prorations per chunk the scalar path is cheaper than building arrays
+VECTOR_PRORATION_MIN = 64
 
 # ---- Utility: rounding money ----
 def money(v):
     return float(Decimal(v).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
 
+def _naive(dt: datetime):
+    # DateTime columns are stored and come back from the DB without tzinfo
+    return dt.replace(tzinfo=None) if dt else dt
+
 # ---- Billing period helpers ----
+# all period boundaries come from the shared billing calendar (billing_calendar.py)
 def next_cycle_start(dt: datetime, cycle: str) -> datetime:
-    if cycle == 'daily':
-        return (dt + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    if cycle == 'weekly':
-        # week start next week's Monday
-        days_until_monday = (7 - dt.weekday()) % 7
-        return (dt + timedelta(days=days_until_monday)).replace(hour=0, minute=0, second=0, microsecond=0)
-    # default monthly: next month first day
-    year = dt.year + (1 if dt.month == 12 else 0)
-    month = 1 if dt.month == 12 else dt.month + 1
-    return datetime(year, month, 1, tzinfo=dt.tzinfo)
+    """Return the first cycle boundary strictly after dt."""
+    return default_calendar.next_boundary(dt, cycle)
 
 def cycle_delta(cycle: str, dt: datetime):
     if cycle == 'daily':
@@ -33,212 +43,395 @@ def cycle_delta(cycle: str, dt: datetime):
     return None
 
 def period_range(start: datetime, cycle: str):
-    """Return (period_start, period_end) given start."""
-    if cycle == 'daily':
-        end = start + timedelta(days=1)
-    elif cycle == 'weekly':
-        end = start + timedelta(weeks=1)
-    else:
-        # monthly: end = start + month length
-        year = start.year + (1 if start.month == 12 else 0)
-        month = 1 if start.month == 12 else start.month + 1
-        end = datetime(year, month, 1, tzinfo=start.tzinfo)
-    return start, end
+    """Return (period_start, period_end) of the cycle period containing start."""
+    return default_calendar.period_containing(start, cycle)
 
 # ---- Proration calculation ----
 def prorated_amount(full_price: float, cycle: str, from_dt: datetime, to_dt: datetime=None):
     """Return prorated portion of full_price for remaining time in cycle.
        If to_dt is None, compute from from_dt to cycle end."""
-    start = from_dt
-    if to_dt is None:
-        # determine period end for the current cycle containing from_dt
-        if cycle == 'daily':
-            end = (from_dt + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        elif cycle == 'weekly':
-            # end: next monday 00:00
-            days_until_monday = (7 - from_dt.weekday()) % 7
-            end = (from_dt + timedelta(days=days_until_monday)).replace(hour=0, minute=0, second=0, microsecond=0)
-            if end <= from_dt:
-                end += timedelta(weeks=1)
-        else:
-            # monthly: end = first of next month
-            year = from_dt.year + (1 if from_dt.month == 12 else 0)
-            month = 1 if from_dt.month == 12 else from_dt.month + 1
-            end = datetime(year, month, 1, tzinfo=from_dt.tzinfo)
-    else:
-        end = to_dt
-
     # total seconds in period and used seconds
-    # find period_start for the cycle (start of current cycle)
-    if cycle == 'daily':
-        period_start = from_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-        period_end = period_start + timedelta(days=1)
-    elif cycle == 'weekly':
-        # find last monday 00:00
-        monday = from_dt - timedelta(days=from_dt.weekday())
-        period_start = monday.replace(hour=0, minute=0, second=0, microsecond=0)
-        period_end = period_start + timedelta(weeks=1)
-    else:
-        period_start = from_dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        year = period_start.year + (1 if period_start.month == 12 else 0)
-        month = 1 if period_start.month == 12 else period_start.month + 1
-        period_end = datetime(year, month, 1, tzinfo=period_start.tzinfo)
+    period_start, period_end = default_calendar.period_containing(from_dt, cycle)
+    end = period_end if to_dt is None else to_dt
 
     total = (period_end - period_start).total_seconds()
     charge_seconds = (end - from_dt).total_seconds()
     ratio = max(0.0, min(1.0, charge_seconds / total))
     return money(full_price * ratio), ratio
 
+# ---- Vectorized proration ----
+def _datetime64(values):
+    """Column of datetimes (or None) -> datetime64[us] array of wall-clock times, None -> NaT."""
+    if isinstance(values, np.ndarray) and np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('M8[us]')
+    return np.array([v.replace(tzinfo=None) if v is not None and v.tzinfo else v for v in values], dtype='M8[us]')
+
+def _money_many(values):
+    """Vectorized money(): round half up to cents, bit-identical to the Decimal version."""
+    values = np.asarray(values, dtype=np.float64)
+    scaled = np.abs(values) * 100
+    cents = np.floor(scaled + 0.5)
+    out = np.copysign(cents, values) / 100
+    # float error in *100 only matters right at a half cent; settle those exactly
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for i in np.flatnonzero(near_half):
+        out[i] = money(values[i])
+    return out
+
+def prorate_many(prices, cycles, from_dts, to_dts=None):
+    """Array version of prorated_amount for bulk repricing and billing.
+       prices, cycles, from_dts and to_dts are equal-length columns (to_dts entries
+       may be None, meaning the end of the cycle). Returns (amounts, ratios) as
+       float64 arrays matching prorated_amount element for element."""
+    prices = np.asarray(prices, dtype=np.float64)
+    cycles = np.asarray(cycles, dtype=object)
+    start = _datetime64(from_dts)
+
+    # period containing start, per cycle (datetime64 day 0 is a Thursday)
+    days = start.astype('M8[D]')
+    weekday = (days.astype(np.int64) + 3) % 7
+    months = start.astype('M8[M]')
+    daily = cycles == 'daily'
+    weekly = cycles == 'weekly'
+    period_start = np.where(daily, days,
+                   np.where(weekly, days - weekday, months.astype('M8[D]')))
+    period_end = np.where(daily, days + 1,
+                 np.where(weekly, days - weekday + 7, (months + 1).astype('M8[D]')))
+    period_start = period_start.astype('M8[us]')
+    period_end = period_end.astype('M8[us]')
+
+    if to_dts is None:
+        end = period_end
+    else:
+        end = _datetime64(to_dts)
+        end = np.where(np.isnat(end), period_end, end)
+
+    # same float arithmetic as timedelta.total_seconds() in the scalar version
+    total = (period_end - period_start).astype(np.int64) / 1e6
+    charge_seconds = (end - start).astype(np.int64) / 1e6
+    ratios = np.clip(charge_seconds / total, 0.0, 1.0)
+    return _money_many(prices * ratios), ratios
+
 # ---- Usage aggregation ----
-def usage_for_subscription(subscription: Subscription, period_start: datetime, period_end: datetime):
-    # sum rx+tx bytes for that subscription and period
-    q = Usage.query.filter(
-        Usage.subscription_id == subscription.id,
+def usage_totals(period_start: datetime, period_end: datetime, subscription_ids=None):
+    """Return {subscription_id: rx+tx bytes} for the period in one grouped query.
+       Restrict to subscription_ids when given. Day/hour aligned periods are read
+       from the usage rollups instead of raw Usage rows."""
+    totals = rollup_totals(period_start, period_end, subscription_ids)
+    if totals is not None:
+        return totals
+    total = db.func.sum(db.func.coalesce(Usage.rx_bytes, 0) + db.func.coalesce(Usage.tx_bytes, 0))
+    q = db.session.query(Usage.subscription_id, total).filter(
         Usage.timestamp >= period_start,
         Usage.timestamp < period_end
     )
-    total_bytes = 0
-    for u in q:
-        total_bytes += (u.rx_bytes or 0) + (u.tx_bytes or 0)
-    return total_bytes
+    if subscription_ids is not None:
+        q = q.filter(Usage.subscription_id.in_(subscription_ids))
+    return {sub_id: int(total_bytes or 0) for sub_id, total_bytes in q.group_by(Usage.subscription_id)}
+
+def usage_for_subscription(subscription: Subscription, period_start: datetime, period_end: datetime):
+    # sum rx+tx bytes for that subscription and period
+    return usage_totals(period_start, period_end, [subscription.id]).get(subscription.id, 0)
+
+# ---- Subscription streaming ----
+def subscription_batches(query, batch_size: int=None, first_id: int=1):
+    """Yield lists of subscriptions from query, batch_size at a time, in id order
+       starting at first_id. Pages by primary key (keyset) so each chunk is a cheap
+       indexed range scan, and eager-loads plan and user to avoid per-row lazy loads."""
+    batch_size = batch_size or BILLING_BATCH_SIZE
+    query = query.options(joinedload(Subscription.plan), joinedload(Subscription.user))
+    last_id = first_id - 1
+    while True:
+        batch = (query.filter(Subscription.id > last_id)
+                      .order_by(Subscription.id)
+                      .limit(batch_size)
+                      .all())
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
 
 # ---- Main billing function ----
-def generate_invoices_for_date(run_date: datetime=None):
+def billing_period_due(sub: Subscription, now: datetime):
+    """Return (period_start, period_end) of the cycle to bill for sub, or None if nothing is due.
+       That is the cycle period containing last_billed_at (or start_at), once it has ended."""
+    # determine last billed or subscription start
+    last_billed = sub.last_billed_at or sub.start_at
+    period_start, period_end = default_calendar.period_containing(last_billed, sub.plan.billing_cycle)
+    if now >= period_end:
+        return period_start, period_end
+    return None
+
+def schedule_next_bill(sub: Subscription, plan: Plan=None):
+    """Set sub.next_bill_at to the end of the cycle period containing last_billed_at
+       (or start_at), i.e. the moment billing_period_due starts returning a period."""
+    plan = plan or sub.plan
+    last_billed = sub.last_billed_at or sub.start_at or datetime.utcnow()
+    sub.next_bill_at = _naive(default_calendar.next_boundary(last_billed, plan.billing_cycle))
+    return sub.next_bill_at
+
+def usage_for_due(due):
+    """Aggregate usage for every (sub, period_start, period_end) in due that bills per GB.
+       Issues one grouped query per distinct period window, not one per subscription."""
+    windows = {}
+    for sub, period_start, period_end in due:
+        if sub.plan.rate_per_gb:
+            windows.setdefault((period_start, period_end), []).append(sub.id)
+    usage = {}
+    for (period_start, period_end), sub_ids in windows.items():
+        totals = usage_totals(period_start, period_end, sub_ids)
+        for sub_id in sub_ids:
+            usage[(sub_id, period_start)] = totals.get(sub_id, 0)
+    return usage
+
+def start_billing_run(run_date: datetime, id_range=None, resume: bool=True):
+    """Return the BillingRun to use for this id_range, or None if another process is running it.
+       A running run whose heartbeat (updated_at) is newer than BILLING_RUN_LEASE is live
+       and left alone. With resume, a failed run over the same range, or a running one
+       whose process stopped heartbeating, is taken over (keeping its original run_date
+       and cursor); otherwise a new run is created."""
+    first_id, last_id = id_range if id_range else (None, None)
+    # comparing with None renders IS NULL, so unbounded runs match each other
+    same_range = db.and_(BillingRun.first_subscription_id == first_id,
+                         BillingRun.last_subscription_id == last_id)
+    now = datetime.utcnow()
+    live = db.and_(BillingRun.status == 'running', BillingRun.updated_at >= now - BILLING_RUN_LEASE)
+    abandoned = db.or_(BillingRun.status == 'failed',
+                       BillingRun.updated_at < now - BILLING_RUN_LEASE,
+                       BillingRun.updated_at.is_(None))
+    if BillingRun.query.filter(same_range, live).first():
+        print(f"[INFO] Billing run for {id_range or 'all subscriptions'} already running elsewhere; skipped")
+        return None
+
+    run = None
+    if resume:
+        run = (BillingRun.query
+               .filter(same_range, BillingRun.status != 'completed')
+               .order_by(BillingRun.id.desc())
+               .first())
+    if run:
+        # conditional on the row still being abandoned and unchanged, so only one process takes it over
+        taken = (BillingRun.query
+                 .filter(BillingRun.id == run.id,
+                         BillingRun.status == run.status,
+                         BillingRun.updated_at == run.updated_at,
+                         abandoned)
+                 .update({BillingRun.status: 'running', BillingRun.error: None, BillingRun.updated_at: now},
+                         synchronize_session=False))
+        db.session.commit()
+        if not taken:
+            print(f"[INFO] Billing run {run.id} is being run by another process; skipped")
+            return None
+        print(f"[INFO] Resuming billing run {run.id} from subscription {run.cursor}")
+        return run
+
+    run = BillingRun(run_date=run_date, first_subscription_id=first_id,
+                     last_subscription_id=last_id, cursor=0, status='running',
+                     subscriptions_processed=0, invoices_created=0, updated_at=now)
+    db.session.add(run)
+    db.session.commit()
+    # two processes starting at once both insert a run; the oldest live one goes ahead
+    if (BillingRun.query
+            .filter(same_range, live, BillingRun.id < run.id)
+            .first()):
+        db.session.delete(run)
+        db.session.commit()
+        print(f"[INFO] Billing run for {id_range or 'all subscriptions'} already running elsewhere; skipped")
+        return None
+    return run
+
+def _checkpoint(run, **values):
+    """Write values (and a fresh heartbeat) to run, only while this process still holds it:
+       its status is still running and updated_at is the heartbeat this process wrote last.
+       Returns False if another process took the run over. The caller commits."""
+    now = datetime.utcnow()
+    held = (BillingRun.query
+            .filter(BillingRun.id == run.id,
+                    BillingRun.status == 'running',
+                    BillingRun.updated_at == run.updated_at)
+            .update(dict(values, updated_at=now), synchronize_session='evaluate'))
+    return bool(held)
+
+def already_invoiced(due):
+    """Return {(subscription_id, period_start)} among due that already have a cycle invoice.
+       Plan-change invoices share the period start but leave the rest of the cycle unbilled."""
+    if not due:
+        return set()
+    rows = db.session.query(Invoice.subscription_id, Invoice.period_start).filter(
+        Invoice.kind == 'cycle',
+        Invoice.subscription_id.in_({sub.id for sub, _, _ in due}),
+        Invoice.period_start.in_({_naive(period_start) for _, period_start, _ in due})
+    )
+    return {(sub_id, _naive(period_start)) for sub_id, period_start in rows}
+
+def generate_invoices_for_date(run_date: datetime=None, batch_size: int=None, id_range=None, resume: bool=True):
     """Top-level driver invoked by scheduler nightly.
        This will:
-         - iterate active subscriptions
+         - stream active subscriptions in chunks of batch_size
+           (only ids inside id_range when given, see parallel_billing)
          - determine if billing is due for their cycle
          - compute price (prorated if needed)
-         - include usage fees if plan.price_per_gb set
-         - create Invoice rows
+         - include usage fees if plan.rate_per_gb set
+         - create Invoice rows, committing once per chunk
+       Progress is checkpointed in a BillingRun in the same commit as each chunk,
+       so a crashed run restarts after the last committed subscription. A run that
+       another process is still working on is skipped (nothing is billed, [] is returned).
     """
     now = run_date or datetime.now(timezone.utc)
     invoices_created = []
 
-    subs = Subscription.query.filter(Subscription.active == True).all()
-    for sub in subs:
-        plan = sub.plan
-        # determine last billed or subscription start
-        last_billed = sub.last_billed_at or sub.start_at
-        # compute next billing point depending on cycle
-        # We will bill for any completed cycles since last_billed
-        # For monthly we bill at start of cycle; implement a conservative approach:
-        needs_billing = False
-        period_start = None
-        period_end = None
-
-        if plan.billing_cycle == 'daily':
-            # bill for each day boundary passed since last_billed
-            # bill on midnight passes
-            next_boundary = (last_billed + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-            if now >= next_boundary:
-                period_start = next_boundary - timedelta(days=1)
-                period_end = next_boundary
-                needs_billing = True
-
-        elif plan.billing_cycle == 'weekly':
-            # find week boundary (monday 00:00) after last_billed
-            # compute last monday after last_billed
-            monday_after = (last_billed - timedelta(days=last_billed.weekday())).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(weeks=1)
-            if now >= monday_after:
-                period_start = monday_after - timedelta(weeks=1)
-                period_end = monday_after
-                needs_billing = True
-
-        else:  # monthly
-            # compute first-of-next-month after last_billed
-            year = last_billed.year + (1 if last_billed.month == 12 else 0)
-            month = 1 if last_billed.month == 12 else last_billed.month + 1
-            first_next_month = datetime(year, month, 1, tzinfo=last_billed.tzinfo)
-            if now >= first_next_month:
-                # period is from first_of_month_containing(last_billed) to first_next_month
-                period_start = last_billed.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                period_end = first_next_month
-                needs_billing = True
-
-        # If subscription started mid-cycle and we are billing first partial period, proration applies
-        if needs_billing and period_start and period_end:
-            # base charge: plan.price for full cycle
-            base_amount = plan.price
-            # If subscription started after period_start => prorate for the active duration.
-            bill_start = max(sub.start_at, period_start)
-            # If user ended subscription before period_end => prorate for partial period
-            bill_end = min(sub.end_at, period_end) if sub.end_at else period_end
-
-            # prorate portion for cycle if not full
-            if bill_start > period_start or bill_end < period_end:
-                # calculate prorated amount for active seconds inside this cycle
-                prorate_amount, ratio = prorated_amount(base_amount, plan.billing_cycle, bill_start, bill_end)
-            else:
-                prorate_amount, ratio = money(base_amount), 1.0
-
-            usage_amount = 0.0
-            if plan.price_per_gb:
-                total_bytes = usage_for_subscription(sub, period_start, period_end)
-                gb_used = total_bytes / (1024**3)
-                usage_amount = money(gb_used * plan.price_per_gb)
-
-            total = money(prorate_amount + usage_amount)
-            invoice = Invoice(
-                user_id=sub.user_id,
-                subscription_id=sub.id,
-                period_start=period_start,
-                period_end=period_end,
-                amount=total,
-                details=json.dumps({
-                    'plan_price': base_amount,
-                    'prorated_price': prorate_amount,
-                    'proration_ratio': ratio,
-                    'usage_bytes': int(total_bytes) if plan.price_per_gb else 0,
-                    'usage_charge': usage_amount
-                })
-            )
-            db.session.add(invoice)
-            # update last_billed_at to period_end
-            sub.last_billed_at = period_end
+    run = start_billing_run(now, id_range, resume)
+    if run is None:
+        return invoices_created
+    now = run.run_date
+    default_calendar.warm(now)
+    first_id = max(run.cursor + 1, id_range[0] if id_range else 1)
+    last_id = id_range[1] if id_range else None
+
+    # only rows that are due (or have never been scheduled) are read, via the next_bill_at index
+    query = Subscription.query.filter(
+        Subscription.active == True,
+        db.or_(Subscription.next_bill_at <= _naive(now), Subscription.next_bill_at.is_(None))
+    )
+    if last_id is not None:
+        query = query.filter(Subscription.id <= last_id)
+    try:
+        for subs in subscription_batches(query, batch_size, first_id=first_id):
+            invoices = bill_subscriptions(subs, now)
+            db.session.add_all(invoices)
+            # the checkpoint doubles as the heartbeat that keeps other processes off this run
+            if not _checkpoint(run, cursor=subs[-1].id,
+                               subscriptions_processed=run.subscriptions_processed + len(subs),
+                               invoices_created=run.invoices_created + len(invoices)):
+                db.session.rollback()
+                print(f"[WARN] Billing run {run.id} was taken over by another process; stopping")
+                return invoices_created
             db.session.commit()
-            invoices_created.append(invoice)
-            # placeholder: optionally call immediate charging
-            # charge_customer(sub.user, invoice)  <-- integrate mpesa here
+            invoices_created.extend(invoices)
+    except Exception as e:
+        db.session.rollback()
+        _checkpoint(run, status='failed', error=f"{type(e).__name__}: {e}")
+        db.session.commit()
+        raise
+
+    _checkpoint(run, status='completed', finished_at=datetime.utcnow())
+    db.session.commit()
     return invoices_created
 
+def bill_subscriptions(subs, now: datetime):
+    """Build invoices for the due subscriptions in subs and advance their last_billed_at.
+       Nothing is committed; the caller adds and commits the returned invoices."""
+    due = []
+    for sub in subs:
+        period = billing_period_due(sub, now)
+        if period:
+            due.append((sub, period[0], period[1]))
+        elif sub.next_bill_at is None:
+            schedule_next_bill(sub)
+
+    # skip periods that already have an invoice (e.g. billed by an earlier, interrupted run)
+    billed = already_invoiced(due)
+    for sub, period_start, period_end in due:
+        if (sub.id, _naive(period_start)) in billed:
+            sub.last_billed_at = period_end
+            schedule_next_bill(sub)
+    due = [d for d in due if (d[0].id, _naive(d[1])) not in billed]
+
+    # usage totals for the whole chunk, grouped in SQL per billing window
+    usage = usage_for_due(due)
+
+    # If subscription started mid-cycle and we are billing first partial period, proration applies
+    prorations = {}
+    partial = []
+    for sub, period_start, period_end in due:
+        # If subscription started after period_start => prorate for the active duration.
+        # A plan change moves last_billed_at into the cycle; only the rest is billed here.
+        bill_start = max(sub.start_at, period_start, _naive(sub.last_billed_at) or period_start)
+        # If user ended subscription before period_end => prorate for partial period
+        bill_end = min(sub.end_at, period_end) if sub.end_at else period_end
+        # prorate portion for cycle if not full
+        if bill_start > period_start or bill_end < period_end:
+            partial.append((sub, bill_start, bill_end))
+
+    # calculate prorated amount for active seconds inside this cycle
+    if len(partial) >= VECTOR_PRORATION_MIN:
+        amounts, ratios = prorate_many(
+            [sub.plan.price for sub, _, _ in partial],
+            [sub.plan.billing_cycle for sub, _, _ in partial],
+            [bill_start for _, bill_start, _ in partial],
+            [bill_end for _, _, bill_end in partial],
+        )
+        for (sub, _, _), amount, ratio in zip(partial, amounts, ratios):
+            prorations[sub.id] = (float(amount), float(ratio))
+    else:
+        for sub, bill_start, bill_end in partial:
+            prorations[sub.id] = prorated_amount(sub.plan.price, sub.plan.billing_cycle, bill_start, bill_end)
+
+    invoices = []
+    for sub, period_start, period_end in due:
+        plan = sub.plan
+        # base charge: plan.price for full cycle
+        base_amount = plan.price
+        prorate_amount, ratio = prorations.get(sub.id) or (money(base_amount), 1.0)
+
+        usage_amount = 0.0
+        total_bytes = 0
+        if plan.rate_per_gb:
+            total_bytes = usage.get((sub.id, period_start), 0)
+            gb_used = total_bytes / (1024**3)
+            usage_amount = money(gb_used * plan.rate_per_gb)
+
+        total = money(prorate_amount + usage_amount)
+        invoices.append(Invoice(
+            user_id=sub.user_id,
+            subscription_id=sub.id,
+            period_start=period_start,
+            period_end=period_end,
+            amount=total,
+            details=json.dumps({
+                'plan_price': base_amount,
+                'prorated_price': prorate_amount,
+                'proration_ratio': ratio,
+                'usage_bytes': int(total_bytes),
+                'usage_charge': usage_amount
+            })
+        ))
+        # update last_billed_at to period_end
+        sub.last_billed_at = period_end
+        schedule_next_bill(sub)
+        # placeholder: optionally call immediate charging
+        # charge_customer(sub.user, invoice)  <-- integrate mpesa here
+    return invoices
+
 # ---- Pro-rate when changing plan mid-cycle ----
 def change_subscription_plan(subscription: Subscription, new_plan: Plan, change_time: datetime=None):
     """
     Apply proration: when user switches plan mid-cycle we:
-      - generate an invoice for the old plan prorated up to change_time (if not already billed)
-      - start a new subscription period on change_time (with last_billed_at updated)
+      - generate a plan_change invoice for the old plan prorated up to change_time (if not already billed)
+      - start a new subscription period on change_time (with last_billed_at updated);
+        the next billing run bills the new plan prorated from there to the cycle end
     """
-    now = change_time or datetime.now(timezone.utc)
+    # stored DateTimes are naive UTC
+    now = _naive(change_time or datetime.now(timezone.utc))
     old_plan = subscription.plan
 
     # determine current cycle's period_start and period_end
-    ps, pe = period_range(subscription.start_at, old_plan.billing_cycle)
+    ps, pe = period_range(now, old_plan.billing_cycle)
     # compute prorated charge for old plan from last_billed_at (or start) up to now
     last_billed = subscription.last_billed_at or subscription.start_at
     if now <= last_billed:
         # nothing to bill
         pass
     else:
-        prorate_amount, ratio = prorated_amount(old_plan.price, old_plan.billing_cycle, now)
-        # NOTE: for correctness compute portion from last_billed -> now within current cycle
-        # Simpler: compute proportion of remaining cycle billed to new_plan and charge old plan for used seconds
-        # We will compute used portion:
-        #used_amount = full_price * used_seconds / total_seconds
-        #used_seconds = (now - period_start).total_seconds()
-        #total_seconds = (period_end - period_start).total_seconds()
-        #used_amount = old_plan.price * (used_seconds/total_seconds)
-        # We'll implement used_amount:
-        period_start = ps
-        period_end = pe
-        used_seconds = (now - period_start).total_seconds()
-        total_seconds = (period_end - period_start).total_seconds()
-        used_ratio = max(0.0, min(1.0, used_seconds / total_seconds))
-        used_amount = money(old_plan.price * used_ratio)
+        # only the part of this cycle not billed yet: an earlier change in the same
+        # cycle already billed up to last_billed_at
+        period_start = max(last_billed, ps)
+        used_amount, used_ratio = prorated_amount(old_plan.price, old_plan.billing_cycle, period_start, now)
 
         invoice = Invoice(
             user_id=subscription.user_id,
             subscription_id=subscription.id,
+            kind='plan_change',
             period_start=period_start,
             period_end=now,
             amount=used_amount,
@@ -254,7 +447,7 @@ def change_subscription_plan(subscription: Subscription, new_plan: Plan, change_
     subscription.plan_id = new_plan.id
     # set last_billed_at to now so new plan's billing starts fresh from now
     subscription.last_billed_at = now
+    schedule_next_bill(subscription, new_plan)
     db.session.commit()
-    # optionally create immediate invoice for new plan prorated for remainder of cycle (if you prefer)
-    # The generate_invoices_for_date will bill at next boundary (or you can create a prorated invoice explicitly here)
+    # generate_invoices_for_date bills the new plan from now to the cycle end at the next boundary
     return subscription
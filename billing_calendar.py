@@ -0,0 +1,82 @@
+# billing_calendar.py
+import threading
+from datetime import date, datetime, timedelta
+
+CYCLES = ('daily', 'weekly', 'monthly')
+
+
+class BillingCalendar:
+    """Calendar-aligned billing periods: days start at midnight, weeks on Monday
+    00:00 and months on the 1st, in the wall clock of the timestamp's tzinfo.
+
+    Every period gets an integer index (day ordinal, week number or year*12+month),
+    so finding the period that contains t is arithmetic on t plus a dict lookup.
+    Boundaries are built once per (cycle, tzinfo) anchor and memoized; warm()
+    precomputes a rolling window around a date, and the cache is trimmed back to
+    max_periods per anchor when it grows past that.
+    """
+
+    def __init__(self, max_periods=5000):
+        self.max_periods = max_periods
+        self._periods = {}  # (cycle, tzinfo) -> {index: (start, end)}
+        self._lock = threading.Lock()
+
+    # ---- index arithmetic ----
+    @staticmethod
+    def _cycle(cycle):
+        # anything unknown bills monthly, like the rest of billing.py
+        return cycle if cycle in CYCLES else 'monthly'
+
+    @staticmethod
+    def _index(cycle, t: datetime):
+        if cycle == 'daily':
+            return t.toordinal()
+        if cycle == 'weekly':
+            # date(1, 1, 1) (ordinal 1) is a Monday
+            return (t.toordinal() - 1) // 7
+        return t.year * 12 + t.month - 1
+
+    @staticmethod
+    def _start(cycle, index, tzinfo):
+        if cycle == 'daily':
+            d = date.fromordinal(index)
+        elif cycle == 'weekly':
+            d = date.fromordinal(index * 7 + 1)
+        else:
+            d = date(index // 12, index % 12 + 1, 1)
+        return datetime(d.year, d.month, d.day, tzinfo=tzinfo)
+
+    def _period(self, cycle, index, tzinfo):
+        periods = self._periods.get((cycle, tzinfo))
+        if periods is None:
+            periods = self._periods.setdefault((cycle, tzinfo), {})
+        period = periods.get(index)
+        if period is None:
+            period = (self._start(cycle, index, tzinfo), self._start(cycle, index + 1, tzinfo))
+            with self._lock:
+                if len(periods) >= self.max_periods:
+                    periods.clear()
+                periods[index] = period
+        return period
+
+    # ---- lookups ----
+    def period_containing(self, t: datetime, cycle: str):
+        """Return (period_start, period_end) of the cycle period with start <= t < end."""
+        cycle = self._cycle(cycle)
+        return self._period(cycle, self._index(cycle, t), t.tzinfo)
+
+    def next_boundary(self, t: datetime, cycle: str) -> datetime:
+        """Return the first period boundary strictly after t."""
+        return self.period_containing(t, cycle)[1]
+
+    def warm(self, around: datetime, cycles=CYCLES, back_days=62, ahead_days=62):
+        """Precompute the periods of each cycle overlapping [around - back_days, around + ahead_days]."""
+        first, last = around - timedelta(days=back_days), around + timedelta(days=ahead_days)
+        for cycle in cycles:
+            cycle = self._cycle(cycle)
+            for index in range(self._index(cycle, first), self._index(cycle, last) + 1):
+                self._period(cycle, index, around.tzinfo)
+
+
+# process-wide calendar shared by every billing path
+default_calendar = BillingCalendar()
@@ -0,0 +1,227 @@
+# callback_worker.py
+import os
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from models import db, CallbackEvent, Transaction, User, Subscription, Plan, record_access_changes
+from radius_integration import grant_wifi_access
+from mikrotik_sessions import provision_hotspot_users
+
+# concurrent RADIUS grants
+CALLBACK_WORKERS = int(os.getenv('CALLBACK_WORKERS', '8'))
+# events claimed per round
+CALLBACK_BATCH_SIZE = int(os.getenv('CALLBACK_BATCH_SIZE', '100'))
+MAX_CALLBACK_ATTEMPTS = 5
+GRANT_RETRIES = 3
+# a claim older than this is assumed to belong to a dead worker and is taken over
+CLAIM_TIMEOUT = timedelta(minutes=5)
+# first retry delay after a failed attempt; doubles with each attempt
+CALLBACK_RETRY_DELAY = timedelta(seconds=int(os.getenv('CALLBACK_RETRY_DELAY', '30')))
+
+
+# ----------------------------
+# Ingestion (called from /callback)
+# ----------------------------
+def enqueue_callback(raw_body: str):
+    """Durably store a raw callback body; processing happens in process_callback_events."""
+    event = CallbackEvent(payload=raw_body, status='pending', attempts=0)
+    db.session.add(event)
+    db.session.commit()
+    return event
+
+
+# ----------------------------
+# Processing
+# ----------------------------
+def parse_callback(data):
+    """Pull the fields we use out of a Daraja stkCallback payload."""
+    stk_data = data.get('Body', {}).get('stkCallback', {})
+    parsed = {
+        'result_code': stk_data.get('ResultCode'),
+        'merchant_request_id': stk_data.get('MerchantRequestID'),
+        'checkout_request_id': stk_data.get('CheckoutRequestID'),
+        'phone': None,
+        'amount': None,
+        'receipt': None,
+    }
+    if parsed['result_code'] == 0:
+        metadata = stk_data['CallbackMetadata']['Item']
+        parsed['phone'] = next((i['Value'] for i in metadata if i['Name'] == 'PhoneNumber'), None)
+        parsed['amount'] = next((i['Value'] for i in metadata if i['Name'] == 'Amount'), None)
+        parsed['receipt'] = next((i['Value'] for i in metadata if i['Name'] == 'MpesaReceiptNumber'), None)
+    return parsed
+
+
+def find_transaction(parsed):
+    """Exact match on the unique CheckoutRequestID; the latest pending transaction for
+       the phone is only used for legacy rows pushed before checkout ids were stored."""
+    if parsed['checkout_request_id']:
+        txn = Transaction.query.filter_by(checkout_request_id=parsed['checkout_request_id']).first()
+        if txn:
+            return txn
+    if parsed['phone']:
+        return (Transaction.query
+                .filter_by(phone=parsed['phone'], status='Pending', checkout_request_id=None)
+                .order_by(Transaction.timestamp.desc())
+                .first())
+    return None
+
+
+def apply_transaction_update(parsed, raw_payload):
+    """Mark the matching pending transaction completed (or failed). Added to the session, not committed."""
+    txn = find_transaction(parsed)
+    if parsed['result_code'] != 0:
+        print("❌ Payment failed or incomplete callback")
+        if txn and txn.status == 'Pending':
+            txn.status = 'Failed'
+            txn.raw_callback = raw_payload
+        return txn
+
+    if txn:
+        txn.status = 'Completed'
+        txn.mpesa_receipt = parsed['receipt']
+        txn.raw_callback = raw_payload
+    return txn
+
+
+def _grant(event_id, phone):
+    # runs in a worker thread: RADIUS only, no ORM access
+    error = None
+    for attempt in range(GRANT_RETRIES):
+        try:
+            grant_wifi_access(username=str(phone))
+            print(f"✅ WiFi access granted for {phone}")
+            return event_id, None
+        except Exception as e:
+            error = str(e)
+            time.sleep(0.5 * 2 ** attempt)
+    return event_id, error
+
+
+def _provision_on_routers(phones):
+    # RADIUS has already granted access; a router that can't be reached now is
+    # caught up by the scheduled sync_fleet run, so failures here are only logged
+    users = (User.query
+             .join(Subscription, Subscription.user_id == User.id)
+             .join(Plan, Subscription.plan_id == Plan.id)
+             .filter(User.phone.in_(phones), Subscription.active.is_(True), Plan.connection_type == 'hotspot')
+             .distinct()
+             .all())
+    if not users:
+        return
+    try:
+        results = provision_hotspot_users(users)
+    except Exception as e:
+        results = {user.phone: f"{type(e).__name__}: {e}" for user in users}
+    for phone, error in results.items():
+        if error:
+            print(f"[WARN] Router provisioning failed for {phone}: {error}")
+
+
+def _claim(batch_size):
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    stale = db.and_(CallbackEvent.status == 'processing', CallbackEvent.claimed_at < now - CLAIM_TIMEOUT)
+    # abandoned claims that already used up their attempts are not retried
+    CallbackEvent.query.filter(stale, CallbackEvent.attempts >= MAX_CALLBACK_ATTEMPTS).update({
+        CallbackEvent.status: 'failed',
+        CallbackEvent.last_error: 'claim abandoned by worker',
+    }, synchronize_session=False)
+    claimable = db.or_(
+        db.and_(CallbackEvent.status == 'pending',
+                db.or_(CallbackEvent.next_attempt_at.is_(None), CallbackEvent.next_attempt_at <= now)),
+        stale
+    )
+    ids = [eid for (eid,) in db.session.query(CallbackEvent.id)
+           .filter(claimable).order_by(CallbackEvent.id).limit(batch_size)]
+    if not ids:
+        db.session.commit()
+        return []
+    # conditional update, so concurrent workers never claim the same event
+    CallbackEvent.query.filter(CallbackEvent.id.in_(ids), claimable).update({
+        CallbackEvent.status: 'processing',
+        CallbackEvent.claimed_by: token,
+        CallbackEvent.claimed_at: now,
+        CallbackEvent.attempts: db.func.coalesce(CallbackEvent.attempts, 0) + 1,
+    }, synchronize_session=False)
+    db.session.commit()
+    return CallbackEvent.query.filter_by(claimed_by=token, status='processing').order_by(CallbackEvent.id).all()
+
+
+def _fail(event, error):
+    event.last_error = error
+    if event.attempts >= MAX_CALLBACK_ATTEMPTS:
+        event.status = 'failed'
+    else:
+        event.status = 'pending'
+        event.next_attempt_at = datetime.utcnow() + CALLBACK_RETRY_DELAY * 2 ** (event.attempts - 1)
+    print(f"[WARN] Callback event {event.id} attempt {event.attempts} failed: {error}")
+
+
+def process_callback_events(max_workers=None, batch_size=None):
+    """
+    Apply queued M-Pesa callbacks: transaction updates are written from this thread
+    (one commit per batch), RADIUS grants run on a bounded thread pool with retries,
+    then granted hotspot subscribers are added on their routers over pooled
+    RouterOS API sessions (mikrotik_sessions.provision_hotspot_users).
+    A grant that still fails leaves the event pending, retried after a growing
+    delay (up to MAX_CALLBACK_ATTEMPTS), without re-applying its transaction
+    update. Must run inside an app context.
+    Returns {'done': n, 'failed': n}.
+    """
+    max_workers = max_workers or CALLBACK_WORKERS
+    batch_size = batch_size or CALLBACK_BATCH_SIZE
+    summary = {'done': 0, 'failed': 0}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while True:
+            events = _claim(batch_size)
+            if not events:
+                break
+
+            grants = {}
+            paid_users = set()
+            for event in events:
+                try:
+                    parsed = parse_callback(json.loads(event.payload))
+                    if event.applied_at is None:
+                        with db.session.begin_nested():
+                            txn = apply_transaction_update(parsed, event.payload)
+                            event.applied_at = datetime.utcnow()
+                        if txn and txn.status == 'Completed' and txn.user_id:
+                            paid_users.add(txn.user_id)
+                    if parsed['result_code'] == 0 and parsed['phone']:
+                        grants[event.id] = parsed['phone']
+                except Exception as e:
+                    _fail(event, f"{type(e).__name__}: {e}")
+            # a payment can change what the portal and router hooks should allow
+            record_access_changes(db.session, paid_users)
+            db.session.commit()
+
+            by_id = {event.id: event for event in events}
+            futures = [pool.submit(_grant, event_id, phone) for event_id, phone in grants.items()]
+            for future in as_completed(futures):
+                event_id, error = future.result()
+                if error:
+                    _fail(by_id[event_id], error)
+
+            # granted hotspot subscribers also get an entry on their router
+            _provision_on_routers({str(phone) for event_id, phone in grants.items()
+                                   if by_id[event_id].status == 'processing'})
+
+            now = datetime.utcnow()
+            for event in events:
+                if event.status == 'processing':
+                    event.status = 'done'
+                    event.processed_at = now
+                    summary['done'] += 1
+                else:
+                    summary['failed'] += 1
+            db.session.commit()
+            if len(events) < batch_size:
+                break
+
+    return summary
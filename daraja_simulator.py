@@ -0,0 +1,183 @@
+# daraja_simulator.py
+"""
+Local stand-in for the Safaricom Daraja endpoints MpesaClient uses, for offline
+load and latency testing of initiate_payment, auto-renew and /callback.
+
+    python daraja_simulator.py --port 5055 --latency 0.3 --failure-rate 0.02 --callback-delay 5
+    MPESA_BASE_URL=http://127.0.0.1:5055 CALLBACK_URL=http://127.0.0.1:5000/callback python app.py
+
+Implements:
+  GET  /oauth/v1/generate                  issues bearer tokens
+  POST /mpesa/stkpush/v1/processrequest    accepts STK pushes, then POSTs the
+                                           stkCallback to CallBackURL after a delay
+  GET  /simulator/stats                    request/callback counters
+"""
+import os
+import time
+import uuid
+import heapq
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+
+config = {
+    'latency': float(os.getenv('SIM_LATENCY', '0.2')),            # mean response latency (s)
+    'jitter': float(os.getenv('SIM_JITTER', '0.1')),              # +/- uniform jitter (s)
+    'failure_rate': float(os.getenv('SIM_FAILURE_RATE', '0')),    # STK pushes rejected with HTTP 500
+    'callback_delay': float(os.getenv('SIM_CALLBACK_DELAY', '3')),  # push -> callback (s)
+    'cancel_rate': float(os.getenv('SIM_CANCEL_RATE', '0')),      # callbacks with ResultCode 1032
+    'token_ttl': int(os.getenv('SIM_TOKEN_TTL', '3599')),
+}
+
+tokens = {}  # token -> expiry (epoch seconds)
+stats = {'oauth': 0, 'stk_push': 0, 'stk_rejected': 0, 'callbacks_sent': 0, 'callbacks_failed': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key):
+    with _stats_lock:
+        stats[key] += 1
+
+
+def _simulate_latency():
+    delay = config['latency'] + random.uniform(-config['jitter'], config['jitter'])
+    if delay > 0:
+        time.sleep(delay)
+
+
+# ----------------------------
+# Callback delivery
+# ----------------------------
+class CallbackDispatcher:
+    """Delivers callbacks once their due time passes, on a bounded thread pool."""
+
+    def __init__(self, workers=32):
+        self._queue = []  # (due, seq, url, payload)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, delay, url, payload):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._queue, (time.monotonic() + delay, self._seq, url, payload))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._cond.wait(timeout)
+                _, _, url, payload = heapq.heappop(self._queue)
+            self._pool.submit(self._deliver, url, payload)
+
+    @staticmethod
+    def _deliver(url, payload):
+        try:
+            requests.post(url, json=payload, timeout=10).raise_for_status()
+            _count('callbacks_sent')
+        except Exception as e:
+            _count('callbacks_failed')
+            print(f"[SIM] Callback to {url} failed: {e}")
+
+
+dispatcher = CallbackDispatcher()
+
+
+def build_callback(push, merchant_request_id, checkout_request_id):
+    if random.random() < config['cancel_rate']:
+        return {"Body": {"stkCallback": {
+            "MerchantRequestID": merchant_request_id,
+            "CheckoutRequestID": checkout_request_id,
+            "ResultCode": 1032,
+            "ResultDesc": "Request cancelled by user",
+        }}}
+    return {"Body": {"stkCallback": {
+        "MerchantRequestID": merchant_request_id,
+        "CheckoutRequestID": checkout_request_id,
+        "ResultCode": 0,
+        "ResultDesc": "The service request is processed successfully.",
+        "CallbackMetadata": {"Item": [
+            {"Name": "Amount", "Value": push.get("Amount")},
+            {"Name": "MpesaReceiptNumber", "Value": uuid.uuid4().hex[:10].upper()},
+            {"Name": "TransactionDate", "Value": int(datetime.now().strftime("%Y%m%d%H%M%S"))},
+            {"Name": "PhoneNumber", "Value": int(push.get("PhoneNumber") or 0)},
+        ]},
+    }}}
+
+
+# ----------------------------
+# Daraja endpoints
+# ----------------------------
+@app.route('/oauth/v1/generate', methods=['GET'])
+def oauth_generate():
+    _simulate_latency()
+    _count('oauth')
+    if not request.authorization:
+        return jsonify({"errorCode": "400.008.01", "errorMessage": "Invalid Authentication passed"}), 400
+    token = uuid.uuid4().hex
+    tokens[token] = time.time() + config['token_ttl']
+    return jsonify({"access_token": token, "expires_in": str(config['token_ttl'])})
+
+
+@app.route('/mpesa/stkpush/v1/processrequest', methods=['POST'])
+def stk_push():
+    _simulate_latency()
+    _count('stk_push')
+    auth = request.headers.get('Authorization', '')
+    token = auth[len('Bearer '):] if auth.startswith('Bearer ') else None
+    if not token or tokens.get(token, 0) < time.time():
+        return jsonify({"requestId": uuid.uuid4().hex, "errorCode": "404.001.03",
+                        "errorMessage": "Invalid Access Token"}), 401
+
+    push = request.get_json(silent=True) or {}
+    if random.random() < config['failure_rate']:
+        _count('stk_rejected')
+        return jsonify({"requestId": uuid.uuid4().hex, "errorCode": "500.001.1001",
+                        "errorMessage": "Unable to lock subscriber, a transaction is already in process for the current subscriber"}), 500
+
+    merchant_request_id = f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1"
+    checkout_request_id = f"ws_CO_{datetime.now().strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:12]}"
+    if push.get("CallBackURL"):
+        dispatcher.schedule(config['callback_delay'], push["CallBackURL"],
+                            build_callback(push, merchant_request_id, checkout_request_id))
+
+    return jsonify({
+        "MerchantRequestID": merchant_request_id,
+        "CheckoutRequestID": checkout_request_id,
+        "ResponseCode": "0",
+        "ResponseDescription": "Success. Request accepted for processing",
+        "CustomerMessage": "Success. Request accepted for processing",
+    })
+
+
+@app.route('/simulator/stats', methods=['GET'])
+def simulator_stats():
+    with _stats_lock:
+        return jsonify({**stats, 'config': config})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local M-Pesa Daraja simulator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--latency', type=float, default=config['latency'])
+    parser.add_argument('--jitter', type=float, default=config['jitter'])
+    parser.add_argument('--failure-rate', type=float, default=config['failure_rate'])
+    parser.add_argument('--callback-delay', type=float, default=config['callback_delay'])
+    parser.add_argument('--cancel-rate', type=float, default=config['cancel_rate'])
+    args = parser.parse_args()
+    config.update(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                  callback_delay=args.callback_delay, cancel_rate=args.cancel_rate)
+
+    print(f"[SIM] Daraja simulator on http://{args.host}:{args.port} {config}")
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -1,6 +1,25 @@
 # extensions.py
+import os
+import sqlite3
+
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 db = SQLAlchemy()
-migrate = Migrate()
\ No newline at end of file
+migrate = Migrate()
+
+# one database for the web app and the scheduler: /callback queues CallbackEvents
+# (and billing queues PendingCharges) that the scheduler process applies
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///wifinite.db')
+
+
+@event.listens_for(Engine, "connect")
+def _sqlite_wal(dbapi_connection, connection_record):
+    # WAL lets readers run alongside bulk writers (usage ingestion, billing chunks)
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
@@ -0,0 +1,50 @@
+# http_pool.py
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _setting(prefix, name, default, cast):
+    return cast(os.getenv(f"{prefix}_{name}", default))
+
+
+def get_session(name: str, pool_size: int=None, retries: int=None, backoff: float=None) -> requests.Session:
+    """
+    Return the process-wide requests.Session for `name` (e.g. "MPESA", "MIKROTIK"),
+    creating it on first use. Connections are kept alive and pooled per host, so
+    repeated calls reuse TCP/TLS connections across requests and worker threads.
+
+    Unset arguments come from the environment:
+      <NAME>_POOL_SIZE  connections kept per host (default 20)
+      <NAME>_RETRIES    retries on connect errors and 502/503/504 (default 3)
+      <NAME>_BACKOFF    exponential backoff factor in seconds (default 0.3)
+    Only reads and deletes are retried once a request was sent; POST/PUT/PATCH
+    create or change things (STK pushes, router entries) and are not.
+    """
+    session = _sessions.get(name)
+    if session is not None:
+        return session
+    with _lock:
+        session = _sessions.get(name)
+        if session is None:
+            pool_size = pool_size or _setting(name, "POOL_SIZE", "20", int)
+            retry = Retry(
+                total=_setting(name, "RETRIES", "3", int) if retries is None else retries,
+                backoff_factor=_setting(name, "BACKOFF", "0.3", float) if backoff is None else backoff,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({"GET", "HEAD", "DELETE", "OPTIONS"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                  max_retries=retry, pool_block=False)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[name] = session
+    return session
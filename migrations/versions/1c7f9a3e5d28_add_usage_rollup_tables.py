@@ -0,0 +1,37 @@
+"""Add hourly and daily usage rollup tables
+
+They are filled from existing usage rows by revision b2d8e4f6a0c9.
+
+Revision ID: 1c7f9a3e5d28
+Revises: d5a8e2f14b90
+Create Date: 2026-10-17 11:20:52.664019
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1c7f9a3e5d28'
+down_revision = 'd5a8e2f14b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for name in ('usage_hourly', 'usage_daily'):
+        op.create_table(name,
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('subscription_id', sa.Integer(), nullable=False),
+            sa.Column('bucket', sa.DateTime(), nullable=False),
+            sa.Column('rx_bytes', sa.BigInteger(), nullable=True),
+            sa.Column('tx_bytes', sa.BigInteger(), nullable=True),
+            sa.ForeignKeyConstraint(['subscription_id'], ['subscription.id'], ),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('subscription_id', 'bucket', name=f'uq_{name}_subscription_bucket')
+        )
+
+
+def downgrade():
+    op.drop_table('usage_daily')
+    op.drop_table('usage_hourly')
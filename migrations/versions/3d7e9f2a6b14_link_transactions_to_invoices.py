@@ -0,0 +1,34 @@
+"""Link transactions to the invoices they settle
+
+Revision ID: 3d7e9f2a6b14
+Revises: a84c0f6b3d51
+Create Date: 2026-10-17 13:41:27.306918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d7e9f2a6b14'
+down_revision = 'a84c0f6b3d51'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('account_reference', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('invoice_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_transaction_account_reference'), ['account_reference'], unique=False)
+        batch_op.create_index(batch_op.f('ix_transaction_invoice_id'), ['invoice_id'], unique=False)
+        batch_op.create_foreign_key('fk_transaction_invoice_id_invoice', 'invoice', ['invoice_id'], ['id'])
+
+
+def downgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_transaction_invoice_id_invoice', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_transaction_invoice_id'))
+        batch_op.drop_index(batch_op.f('ix_transaction_account_reference'))
+        batch_op.drop_column('invoice_id')
+        batch_op.drop_column('account_reference')
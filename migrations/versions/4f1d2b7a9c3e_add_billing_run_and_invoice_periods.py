@@ -0,0 +1,50 @@
+"""Add billing_run checkpoint table and invoice billing periods
+
+Revision ID: 4f1d2b7a9c3e
+Revises: c26984ba94bc
+Create Date: 2026-10-17 09:12:40.518211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f1d2b7a9c3e'
+down_revision = 'c26984ba94bc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('billing_run',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('run_date', sa.DateTime(), nullable=False),
+        sa.Column('first_subscription_id', sa.Integer(), nullable=True),
+        sa.Column('last_subscription_id', sa.Integer(), nullable=True),
+        sa.Column('cursor', sa.Integer(), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('subscriptions_processed', sa.Integer(), nullable=True),
+        sa.Column('invoices_created', sa.Integer(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('period_start', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('period_end', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('details', sa.Text(), nullable=True))
+        batch_op.create_unique_constraint('uq_invoice_subscription_period', ['subscription_id', 'period_start'])
+
+
+def downgrade():
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_invoice_subscription_period', type_='unique')
+        batch_op.drop_column('details')
+        batch_op.drop_column('period_end')
+        batch_op.drop_column('period_start')
+
+    op.drop_table('billing_run')
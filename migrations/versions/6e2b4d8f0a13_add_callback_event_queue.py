@@ -0,0 +1,43 @@
+"""Add callback_event queue for M-Pesa callbacks
+
+Revision ID: 6e2b4d8f0a13
+Revises: 1c7f9a3e5d28
+Create Date: 2026-10-17 12:05:38.214870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2b4d8f0a13'
+down_revision = '1c7f9a3e5d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('callback_event',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('claimed_by', sa.String(length=40), nullable=True),
+        sa.Column('claimed_at', sa.DateTime(), nullable=True),
+        sa.Column('applied_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('received_at', sa.DateTime(), nullable=True),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('callback_event', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_callback_event_status'), ['status'], unique=False)
+        batch_op.create_index(batch_op.f('ix_callback_event_claimed_by'), ['claimed_by'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('callback_event', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_callback_event_claimed_by'))
+        batch_op.drop_index(batch_op.f('ix_callback_event_status'))
+
+    op.drop_table('callback_event')
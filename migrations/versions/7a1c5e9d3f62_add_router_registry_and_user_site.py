@@ -0,0 +1,50 @@
+"""Add router registry and user site
+
+Revision ID: 7a1c5e9d3f62
+Revises: 3d7e9f2a6b14
+Create Date: 2026-10-17 14:22:51.774310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a1c5e9d3f62'
+down_revision = '3d7e9f2a6b14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('router',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=80), nullable=False),
+        sa.Column('site', sa.String(length=80), nullable=True),
+        sa.Column('host', sa.String(length=120), nullable=False),
+        sa.Column('rest_url', sa.String(length=200), nullable=True),
+        sa.Column('username', sa.String(length=80), nullable=False),
+        sa.Column('password', sa.String(length=120), nullable=False),
+        sa.Column('max_concurrency', sa.Integer(), nullable=True),
+        sa.Column('active', sa.Boolean(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name')
+    )
+    with op.batch_alter_table('router', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_router_site'), ['site'], unique=False)
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('site', sa.String(length=80), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_site'), ['site'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_site'))
+        batch_op.drop_column('site')
+
+    with op.batch_alter_table('router', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_router_site'))
+
+    op.drop_table('router')
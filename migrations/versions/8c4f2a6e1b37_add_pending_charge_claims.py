@@ -0,0 +1,32 @@
+"""Add claim and retry columns to pending_charge
+
+Revision ID: 8c4f2a6e1b37
+Revises: 7a1c5e9d3f62
+Create Date: 2026-10-17 15:12:44.381027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4f2a6e1b37'
+down_revision = '7a1c5e9d3f62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('pending_charge', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('claimed_by', sa.String(length=40), nullable=True))
+        batch_op.add_column(sa.Column('claimed_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_pending_charge_claimed_by'), ['claimed_by'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('pending_charge', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_pending_charge_claimed_by'))
+        batch_op.drop_column('next_attempt_at')
+        batch_op.drop_column('claimed_at')
+        batch_op.drop_column('claimed_by')
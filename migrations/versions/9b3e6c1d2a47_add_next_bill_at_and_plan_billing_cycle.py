@@ -0,0 +1,35 @@
+"""Add subscription.next_bill_at index and plan.billing_cycle
+
+Revision ID: 9b3e6c1d2a47
+Revises: 4f1d2b7a9c3e
+Create Date: 2026-10-17 10:02:11.730415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3e6c1d2a47'
+down_revision = '4f1d2b7a9c3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('plan', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('billing_cycle', sa.String(length=20), nullable=True))
+
+    # existing rows start with NULL next_bill_at; the next billing run schedules them
+    with op.batch_alter_table('subscription', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('next_bill_at', sa.DateTime(), nullable=True))
+        batch_op.create_index('ix_subscription_active_next_bill_at', ['active', 'next_bill_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('subscription', schema=None) as batch_op:
+        batch_op.drop_index('ix_subscription_active_next_bill_at')
+        batch_op.drop_column('next_bill_at')
+
+    with op.batch_alter_table('plan', schema=None) as batch_op:
+        batch_op.drop_column('billing_cycle')
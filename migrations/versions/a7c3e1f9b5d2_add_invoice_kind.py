@@ -0,0 +1,40 @@
+"""Add invoice kind; only cycle invoices are unique per subscription period
+
+Plan-change invoices start at the same period_start as the cycle invoice that
+later bills the rest of the period, so the unique constraint becomes a partial
+unique index over kind = 'cycle'. Existing plan-change invoices are recognised
+by the note billing.change_subscription_plan writes into details.
+
+Revision ID: a7c3e1f9b5d2
+Revises: f6b1d3e8a2c5
+Create Date: 2026-10-17 18:05:27.913406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e1f9b5d2'
+down_revision = 'f6b1d3e8a2c5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('kind', sa.String(length=20), nullable=False, server_default='cycle'))
+        batch_op.drop_constraint('uq_invoice_subscription_period', type_='unique')
+
+    op.execute("UPDATE invoice SET kind = 'plan_change' WHERE details LIKE '%mid-cycle change%'")
+
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.create_index('uq_invoice_subscription_period', ['subscription_id', 'period_start'], unique=True,
+                              sqlite_where=sa.text("kind = 'cycle'"), postgresql_where=sa.text("kind = 'cycle'"))
+
+
+def downgrade():
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.drop_index('uq_invoice_subscription_period')
+        batch_op.create_unique_constraint('uq_invoice_subscription_period', ['subscription_id', 'period_start'])
+        batch_op.drop_column('kind')
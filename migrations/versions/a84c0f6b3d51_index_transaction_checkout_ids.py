@@ -0,0 +1,28 @@
+"""Unique indexes on transaction STK request ids
+
+Revision ID: a84c0f6b3d51
+Revises: 6e2b4d8f0a13
+Create Date: 2026-10-17 12:38:04.951302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a84c0f6b3d51'
+down_revision = '6e2b4d8f0a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_transaction_checkout_request_id'), ['checkout_request_id'], unique=True)
+        batch_op.create_index(batch_op.f('ix_transaction_merchant_request_id'), ['merchant_request_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_transaction_merchant_request_id'))
+        batch_op.drop_index(batch_op.f('ix_transaction_checkout_request_id'))
@@ -0,0 +1,79 @@
+"""Backfill hourly and daily usage rollups from raw usage rows
+
+Billing reads aligned periods from the rollups, so they must hold all existing
+usage before that code runs. Both rollups are rebuilt from scratch by the
+database with INSERT ... SELECT ... GROUP BY.
+
+Revision ID: b2d8e4f6a0c9
+Revises: 8c4f2a6e1b37
+Create Date: 2026-10-17 15:40:18.502736
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d8e4f6a0c9'
+down_revision = '8c4f2a6e1b37'
+branch_labels = None
+depends_on = None
+
+usage = sa.table('usage',
+    sa.column('id', sa.Integer),
+    sa.column('subscription_id', sa.Integer),
+    sa.column('timestamp', sa.DateTime),
+    sa.column('rx_bytes', sa.BigInteger),
+    sa.column('tx_bytes', sa.BigInteger),
+)
+
+
+def _rollup_table(name):
+    return sa.table(name,
+        sa.column('subscription_id', sa.Integer),
+        sa.column('bucket', sa.DateTime),
+        sa.column('rx_bytes', sa.BigInteger),
+        sa.column('tx_bytes', sa.BigInteger),
+    )
+
+
+def _bucket(conn, unit):
+    """SQL expression truncating usage.timestamp to the start of its hour or day."""
+    ts = usage.c.timestamp
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        return sa.func.date_trunc(unit, ts)
+    fmt = '%Y-%m-%d %H:00:00' if unit == 'hour' else '%Y-%m-%d 00:00:00'
+    if dialect == 'mysql':
+        return sa.cast(sa.func.date_format(ts, fmt), sa.DateTime)
+    # SQLite keeps DateTime as text in SQLAlchemy's format, microseconds included;
+    # buckets must match it exactly to compare and conflict like ORM-written ones
+    return sa.func.strftime(fmt + '.000000', ts)
+
+
+def upgrade():
+    # aggregated by the database in one INSERT ... SELECT per rollup, so the size of
+    # the usage table never has to fit in memory here
+    conn = op.get_bind()
+    for name, unit in (('usage_hourly', 'hour'), ('usage_daily', 'day')):
+        table = _rollup_table(name)
+        # bucketed in a subquery, so GROUP BY names a column rather than repeating the expression
+        rows = (
+            sa.select(usage.c.subscription_id, _bucket(conn, unit).label('bucket'),
+                      sa.func.coalesce(usage.c.rx_bytes, 0).label('rx_bytes'),
+                      sa.func.coalesce(usage.c.tx_bytes, 0).label('tx_bytes'))
+            .where(usage.c.subscription_id.isnot(None), usage.c.timestamp.isnot(None))
+            .subquery()
+        )
+        totals = (
+            sa.select(rows.c.subscription_id, rows.c.bucket,
+                      sa.func.sum(rows.c.rx_bytes), sa.func.sum(rows.c.tx_bytes))
+            .group_by(rows.c.subscription_id, rows.c.bucket)
+        )
+        conn.execute(table.delete())
+        conn.execute(table.insert().from_select(['subscription_id', 'bucket', 'rx_bytes', 'tx_bytes'], totals))
+
+
+def downgrade():
+    # the rollups are derived data; leave them as they are
+    pass
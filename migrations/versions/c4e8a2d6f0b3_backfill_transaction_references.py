@@ -0,0 +1,39 @@
+"""Backfill account_reference on transactions from before references were stored
+
+Before 3d7e9f2a6b14 every transaction was a plan purchase started by
+initiate_payment, which always sent SUB<id> as the AccountReference. Storing it
+keeps reconciliation from treating those payments as unreferenced and settling
+invoices with them.
+
+Revision ID: c4e8a2d6f0b3
+Revises: a7c3e1f9b5d2
+Create Date: 2026-10-17 18:52:44.170385
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2d6f0b3'
+down_revision = 'a7c3e1f9b5d2'
+branch_labels = None
+depends_on = None
+
+transaction = sa.table('transaction',
+    sa.column('id', sa.Integer),
+    sa.column('account_reference', sa.String),
+)
+
+
+def upgrade():
+    op.execute(
+        transaction.update()
+        .where(transaction.c.account_reference.is_(None))
+        .values(account_reference=sa.literal('SUB', sa.String) + sa.cast(transaction.c.id, sa.String))
+    )
+
+
+def downgrade():
+    # the references are what was sent with the STK push; leave them as they are
+    pass
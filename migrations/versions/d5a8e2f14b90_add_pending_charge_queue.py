@@ -0,0 +1,43 @@
+"""Add pending_charge queue for auto-renew STK pushes
+
+Revision ID: d5a8e2f14b90
+Revises: 9b3e6c1d2a47
+Create Date: 2026-10-17 10:41:27.093166
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5a8e2f14b90'
+down_revision = '9b3e6c1d2a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('pending_charge',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('invoice_id', sa.Integer(), nullable=False),
+        sa.Column('subscription_id', sa.Integer(), nullable=False),
+        sa.Column('phone', sa.String(length=20), nullable=False),
+        sa.Column('amount', sa.Float(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('response', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['invoice_id'], ['invoice.id'], ),
+        sa.ForeignKeyConstraint(['subscription_id'], ['subscription.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('pending_charge', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_pending_charge_status'), ['status'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('pending_charge', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_pending_charge_status'))
+
+    op.drop_table('pending_charge')
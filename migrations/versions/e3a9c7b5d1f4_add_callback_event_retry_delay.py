@@ -0,0 +1,26 @@
+"""Add next_attempt_at to callback_event
+
+Revision ID: e3a9c7b5d1f4
+Revises: b2d8e4f6a0c9
+Create Date: 2026-10-17 16:03:27.918452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a9c7b5d1f4'
+down_revision = 'b2d8e4f6a0c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('callback_event', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('callback_event', schema=None) as batch_op:
+        batch_op.drop_column('next_attempt_at')
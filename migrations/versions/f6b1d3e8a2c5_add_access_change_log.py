@@ -0,0 +1,34 @@
+"""Add access_change log for cross-process access cache invalidation
+
+Revision ID: f6b1d3e8a2c5
+Revises: e3a9c7b5d1f4
+Create Date: 2026-10-17 16:31:09.442718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6b1d3e8a2c5'
+down_revision = 'e3a9c7b5d1f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('access_change',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('access_change', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_access_change_created_at'), ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('access_change', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_access_change_created_at'))
+
+    op.drop_table('access_change')
@@ -0,0 +1,210 @@
+# mikrotik_sessions.py
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from routeros_api import RouterOsApiPool
+from routeros_api.exceptions import RouterOsApiCommunicationError
+
+import network_manager
+from router_fleet import run_on_routers
+
+# authenticated API sessions kept open per router (a registry router's max_concurrency wins)
+ROUTEROS_SESSIONS_PER_ROUTER = int(os.getenv('ROUTEROS_SESSIONS_PER_ROUTER', '2'))
+# seconds to wait for a free session before giving up
+ROUTEROS_SESSION_TIMEOUT = float(os.getenv('ROUTEROS_SESSION_TIMEOUT', '10'))
+# sessions idle longer than this are health-checked before use
+ROUTEROS_PING_AFTER = float(os.getenv('ROUTEROS_PING_AFTER', '30'))
+# hotspot adds in flight on one session during add_hotspot_users
+HOTSPOT_PIPELINE_WINDOW = int(os.getenv('HOTSPOT_PIPELINE_WINDOW', '100'))
+HOTSPOT_PROFILE = os.getenv('HOTSPOT_PROFILE', 'default')
+
+
+class RouterSessionPool:
+    """
+    Long-lived, logged-in RouterOS API sessions to one router. Sessions are
+    handed out one caller at a time, health-checked after sitting idle and
+    replaced when a call fails on a broken connection.
+    """
+
+    def __init__(self, host, username, password, size=ROUTEROS_SESSIONS_PER_ROUTER):
+        self.host = host
+        self.username = username
+        self.password = password
+        self._idle = deque()  # (connection pool, api, last used)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        connection = RouterOsApiPool(self.host, username=self.username, password=self.password,
+                                     plaintext_login=True)
+        return connection, connection.get_api()
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.disconnect()
+        except Exception:
+            pass
+
+    def _healthy(self, api):
+        try:
+            api.get_resource('/system/identity').get()
+            return True
+        except Exception:
+            return False
+
+    def _checkout(self):
+        try:
+            connection, api, last_used = self._idle.pop()
+        except IndexError:
+            return self._connect()
+        if time.monotonic() - last_used > ROUTEROS_PING_AFTER and not self._healthy(api):
+            self._close(connection)
+            return self._connect()
+        return connection, api
+
+    @contextmanager
+    def api(self):
+        """Yield a logged-in api object. A failure other than a router-side error
+           (e.g. "already have user with this name") drops the session."""
+        if not self._slots.acquire(timeout=ROUTEROS_SESSION_TIMEOUT):
+            raise TimeoutError(f"No RouterOS API session free for {self.host} after {ROUTEROS_SESSION_TIMEOUT}s")
+        connection = None
+        try:
+            connection, api = self._checkout()
+            yield api
+        except RouterOsApiCommunicationError:
+            # the router answered; the session itself is fine
+            if connection is not None:
+                self._idle.append((connection, api, time.monotonic()))
+                connection = None
+            raise
+        except Exception:
+            if connection is not None:
+                self._close(connection)
+                connection = None
+            raise
+        finally:
+            if connection is not None:
+                self._idle.append((connection, api, time.monotonic()))
+            self._slots.release()
+
+    def close(self):
+        while self._idle:
+            self._close(self._idle.pop()[0])
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def session_pool(ip="192.168.88.1", username="Admin", password="1234", router=None):
+    """The process-wide RouterSessionPool for a router (registry RouterRef or address/login)."""
+    size = ROUTEROS_SESSIONS_PER_ROUTER
+    if router is not None:
+        ip, username, password, size = router.host, router.username, router.password, router.max_concurrency
+    key = (ip, username)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.password != password:
+            if pool is not None:
+                pool.close()
+            pool = _pools[key] = RouterSessionPool(ip, username, password, size)
+        return pool
+
+
+def _with_retry(pool, fn):
+    # one retry on a fresh session if the pooled one turned out to be dead
+    try:
+        with pool.api() as api:
+            return fn(api)
+    except (RouterOsApiCommunicationError, TimeoutError):
+        raise
+    except Exception as e:
+        print(f"[WARN] RouterOS session to {pool.host} failed ({e}), reconnecting")
+        with pool.api() as api:
+            return fn(api)
+
+
+def _already_exists(error):
+    return "already have" in error
+
+
+def allow_user_on_mikrotik(ip="192.168.88.1", username="Admin", password="1234", user_phone="254712345678",
+                           router=None, user_password=None, profile=HOTSPOT_PROFILE):
+    # same password and tag as the router sync, so the sync owns these entries afterwards
+    user_password = user_password or network_manager.ROUTER_USER_PASSWORD
+    if not user_password:
+        raise ValueError("ROUTER_USER_PASSWORD is not set; refusing to create a local hotspot user")
+    pool = session_pool(ip, username, password, router)
+
+    # Add user to hotspot
+    _with_retry(pool, lambda api: api.get_resource('/ip/hotspot/user').add(
+        name=user_phone,
+        password=user_password,
+        profile=profile,
+        comment=network_manager.SYNC_COMMENT
+    ))
+
+    print(f"✅ Mikrotik user {user_phone} added successfully.")
+
+
+def add_hotspot_users(users, ip="192.168.88.1", username="Admin", password="1234", router=None,
+                      profile=HOTSPOT_PROFILE, window=HOTSPOT_PIPELINE_WINDOW):
+    """
+    Add many hotspot users over one pooled session. users yields (name, password)
+    pairs; up to `window` add commands are sent before their replies are read,
+    so the cost is one round trip per window rather than per user. Entries are
+    tagged for the router sync; a user that already exists counts as added.
+    Returns {name: None on success, else the router's error}.
+    """
+    pool = session_pool(ip, username, password, router)
+    users = list(users)
+    results = {}
+
+    def send(api):
+        resource = api.get_resource('/ip/hotspot/user')
+        for start in range(0, len(users), window):
+            pending = [
+                (name, resource.call_async('add', {'name': name, 'password': user_password, 'profile': profile,
+                                                   'comment': network_manager.SYNC_COMMENT}))
+                for name, user_password in users[start:start + window]
+                if name not in results
+            ]
+            for name, reply in pending:
+                try:
+                    reply.get()
+                    results[name] = None
+                except RouterOsApiCommunicationError as e:
+                    error = str(e.args[0]) if e.args else str(e)
+                    results[name] = None if _already_exists(error) else error
+
+    # after a reconnect, only users without a result are sent again
+    _with_retry(pool, send)
+    return results
+
+
+def provision_hotspot_users(users, max_workers=None):
+    """
+    Create hotspot entries for newly activated subscribers (User rows) on each
+    one's router: routers in parallel, each router's adds pipelined over a
+    pooled session. Skipped (returns {}) while ROUTER_USER_PASSWORD is unset,
+    since a shared default would let anyone log in with a subscriber's phone.
+    Must run inside an app context. Returns {phone: None or error}.
+    """
+    user_password = network_manager.ROUTER_USER_PASSWORD
+    if not user_password:
+        return {}
+    by_router = {}
+    for user in users:
+        by_router.setdefault(network_manager.router_for(user), []).append((str(user.phone), user_password))
+    results = {}
+    jobs = [(router, add_hotspot_users, (pairs,)) for router, pairs in by_router.items()]
+    for (_, _, (pairs,)), result, error in run_on_routers(jobs, max_workers):
+        if error:
+            results.update((name, error) for name, _ in pairs)
+        else:
+            results.update(result)
+    return results
@@ -2,7 +2,8 @@
 from extensions import db
 from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import relationship, Session
 from werkzeug.security import generate_password_hash
 
 class User(db.Model):
@@ -21,6 +22,8 @@ class User(db.Model):
     invoices = db.relationship('Invoice', backref='user', lazy=True)
     plan_id = db.Column(db.Integer, db.ForeignKey('plan.id'))  # ✅ add this
     plan = db.relationship('Plan', backref='users', lazy=True)  # ✅ add this
+    # site the subscriber connects from; picks their router (see router_fleet.py)
+    site = db.Column(db.String(80), nullable=True, index=True)
 
     def remaining_data(self):
         if self.plan:
@@ -49,6 +52,7 @@ class Plan(db.Model):
     duration_days = db.Column(db.Integer, nullable=False, default=30)
     connection_type = db.Column(db.String(20), nullable=False)  # hotspot, pppoe, static_ip
     billing_type = db.Column(db.String(20), default='flat')  # flat, data, time
+    billing_cycle = db.Column(db.String(20), default='monthly')  # daily, weekly, monthly
     rate_per_gb = db.Column(db.Float, nullable=True)  # for data-based plans
     rate_per_hour = db.Column(db.Float, nullable=True)  # for time-based plans
     data_bytes = db.Column(db.BigInteger, nullable=True)
@@ -74,6 +78,12 @@ class Subscription(db.Model):
     usage_bytes = db.Column(db.BigInteger, default=0)
     usage_hours = db.Column(db.Float, default=0)
     mid_cycle_plan_change = db.Column(db.Boolean, default=False)
+    # when the next invoice falls due; kept up to date by billing.schedule_next_bill
+    next_bill_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_subscription_active_next_bill_at', 'active', 'next_bill_at'),
+    )
 
     # Removed user = db.relationship('User', lazy=True)
     plan = db.relationship('Plan', back_populates='subscriptions')
@@ -105,12 +115,33 @@ class Transaction(db.Model):
     status = db.Column(db.String(40), default='Pending')  # Pending, Completed, Failed
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     mpesa_receipt = db.Column(db.String(100), nullable=True)
-    merchant_request_id = db.Column(db.String(100), nullable=True)
-    checkout_request_id = db.Column(db.String(100), nullable=True)
+    # returned by the STK push; callbacks are matched on checkout_request_id
+    merchant_request_id = db.Column(db.String(100), nullable=True, unique=True, index=True)
+    checkout_request_id = db.Column(db.String(100), nullable=True, unique=True, index=True)
     raw_callback = db.Column(db.Text, nullable=True)
     plan_id = db.Column(db.Integer, db.ForeignKey('plan.id'), nullable=True)
+    # AccountReference sent with the STK push (INV<id> for invoice charges)
+    account_reference = db.Column(db.String(20), nullable=True, index=True)
+    # invoice this payment settled, set by reconciliation.py
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=True, index=True)
 
     plan = db.relationship('Plan', lazy=True)
+    invoice = db.relationship('Invoice', lazy=True)
+
+
+class CallbackEvent(db.Model):
+    """Raw M-Pesa callback stored by /callback and applied later by callback_worker.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, processing, done, failed
+    attempts = db.Column(db.Integer, default=0)
+    claimed_by = db.Column(db.String(40), nullable=True, index=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)  # retry backoff; NULL = process now
+    applied_at = db.Column(db.DateTime, nullable=True)  # transaction update committed
+    last_error = db.Column(db.Text, nullable=True)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
 
 
 class Ticket(db.Model):
@@ -130,6 +161,46 @@ class Usage(db.Model):
     tx_bytes = db.Column(db.BigInteger, default=0)
 
 
+@event.listens_for(Session, 'after_flush')
+def _rollup_new_usage(session, flush_context):
+    # Usage rows are append-only; new rows added through the ORM are rolled up in the
+    # same transaction. Registered here so it is active wherever Usage can be flushed.
+    rows = [
+        (obj.subscription_id, obj.timestamp, obj.rx_bytes, obj.tx_bytes)
+        for obj in session.new
+        if isinstance(obj, Usage) and obj.subscription_id is not None
+    ]
+    if rows:
+        from usage_rollup import apply_to_rollups
+        apply_to_rollups(session.connection(), rows)
+
+
+class UsageHourly(db.Model):
+    """Usage summed per subscription and hour; maintained by usage_rollup.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False)  # start of the hour
+    rx_bytes = db.Column(db.BigInteger, default=0)
+    tx_bytes = db.Column(db.BigInteger, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('subscription_id', 'bucket', name='uq_usage_hourly_subscription_bucket'),
+    )
+
+
+class UsageDaily(db.Model):
+    """Usage summed per subscription and day; maintained by usage_rollup.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False)  # midnight
+    rx_bytes = db.Column(db.BigInteger, default=0)
+    tx_bytes = db.Column(db.BigInteger, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('subscription_id', 'bucket', name='uq_usage_daily_subscription_bucket'),
+    )
+
+
 class Invoice(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -140,6 +211,17 @@ class Invoice(db.Model):
     generated_at = db.Column(db.DateTime, default=datetime.utcnow)
     due_date = db.Column(db.DateTime, default=lambda: datetime.utcnow() + timedelta(days=3))
     paid_at = db.Column(db.DateTime, nullable=True)
+    period_start = db.Column(db.DateTime, nullable=True)
+    period_end = db.Column(db.DateTime, nullable=True)
+    details = db.Column(db.Text, nullable=True)  # JSON breakdown from billing.py
+    # cycle: regular billing run; plan_change: old plan's share billed by change_subscription_plan
+    kind = db.Column(db.String(20), nullable=False, default='cycle', server_default='cycle')
+
+    # a subscription gets at most one cycle invoice per period, so re-running billing is safe
+    __table_args__ = (
+        db.Index('uq_invoice_subscription_period', 'subscription_id', 'period_start', unique=True,
+                 sqlite_where=db.text("kind = 'cycle'"), postgresql_where=db.text("kind = 'cycle'")),
+    )
     
     def mark_paid(self):
         self.status = 'Paid'
@@ -147,6 +229,110 @@ class Invoice(db.Model):
         invoices = Invoice.query.filter_by(user_id=session['user_id']).all()
         return render_template('invoice.html', invoices=invoices)
 
+class PendingCharge(db.Model):
+    """Auto-renew STK push queued by billing and sent later by auto_renew.dispatch_pending_charges."""
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
+    phone = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    claimed_by = db.Column(db.String(40), nullable=True, index=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)  # retry backoff; NULL = send now
+    response = db.Column(db.Text, nullable=True)  # raw STK push response or error
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    invoice = db.relationship('Invoice', backref='charges')
+    subscription = db.relationship('Subscription')
+
+class BillingRun(db.Model):
+    """Checkpoint for billing.generate_invoices_for_date so a crashed run can resume."""
+    id = db.Column(db.Integer, primary_key=True)
+    run_date = db.Column(db.DateTime, nullable=False)
+    # inclusive subscription id range covered by this run (None = unbounded)
+    first_subscription_id = db.Column(db.Integer, nullable=True)
+    last_subscription_id = db.Column(db.Integer, nullable=True)
+    cursor = db.Column(db.Integer, default=0)  # last subscription id committed
+    status = db.Column(db.String(20), default='running')  # running, completed, failed
+    subscriptions_processed = db.Column(db.Integer, default=0)
+    invoices_created = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<BillingRun {self.id} {self.status} cursor={self.cursor}>'
+
+class Router(db.Model):
+    """A MikroTik router in the fleet. Subscribers are mapped to routers by router_fleet.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    site = db.Column(db.String(80), nullable=True, index=True)
+    host = db.Column(db.String(120), nullable=False)  # IP/hostname for the RouterOS API
+    rest_url = db.Column(db.String(200), nullable=True)  # defaults to http://<host>/rest
+    username = db.Column(db.String(80), nullable=False)
+    password = db.Column(db.String(120), nullable=False)
+    # provisioning calls allowed in flight against this router at once
+    max_concurrency = db.Column(db.Integer, default=4)
+    active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Router {self.name} {self.host}>'
+
+class AccessChange(db.Model):
+    """A user whose access decision changed (user_id NULL = everyone). Every process
+       reads this log so its bandwidth_control.AccessCache drops stale entries."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+def record_access_changes(session, user_ids):
+    """Log that these users' access decisions changed (None = everyone), inside the
+       session's transaction. This process's cache drops them on commit, other
+       processes on their next sync (see bandwidth_control.AccessCache.sync)."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    session.info.setdefault('access_invalidations', set()).update(user_ids)
+    now = datetime.utcnow()
+    session.connection().execute(AccessChange.__table__.insert(), [
+        {'user_id': user_id, 'created_at': now} for user_id in user_ids
+    ])
+
+
+# data_used is left out: every usage increment would evict the user everywhere. Other
+# processes see quota_remaining up to ACCESS_CACHE_TTL late; crossing the quota flips
+# is_active (bandwidth_control.update_data_usage), which is logged
+_ACCESS_USER_FIELDS = ('plan_id', 'is_active')
+_ACCESS_SUBSCRIPTION_FIELDS = ('plan_id', 'active')
+_ACCESS_PLAN_FIELDS = ('data_quota', 'download_speed', 'upload_speed')
+
+
+def _changed(obj, fields):
+    attrs = inspect(obj).attrs
+    return any(attrs[name].history.has_changes() for name in fields)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_access_changes(session, flush_context):
+    # ORM edits to anything an access decision is built from are logged in the same transaction
+    changed = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and (obj in session.deleted or _changed(obj, _ACCESS_USER_FIELDS)):
+            changed.add(obj.id)
+        elif (isinstance(obj, Subscription) and obj.user_id is not None
+              and (obj in session.new or _changed(obj, _ACCESS_SUBSCRIPTION_FIELDS))):
+            changed.add(obj.user_id)
+        elif isinstance(obj, Plan) and _changed(obj, _ACCESS_PLAN_FIELDS):
+            changed.add(None)  # affects every user on the plan
+    record_access_changes(session, changed)
+
 class Admin(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
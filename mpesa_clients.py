@@ -1,13 +1,57 @@
 # mpesa_clients.py
 import os
-import requests
+import time
+import threading
 import base64
+from http_pool import get_session
 from requests.auth import HTTPBasicAuth
 from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# refresh the OAuth token this many seconds before Daraja says it expires
+TOKEN_REFRESH_MARGIN = int(os.getenv("MPESA_TOKEN_REFRESH_MARGIN", "120"))
+
+
+class _TokenCache:
+    """Process-wide OAuth token cache shared by every MpesaClient.
+    Tokens are keyed by (base_url, consumer_key). Refreshes are single-flight:
+    one thread fetches while others wait on the per-key lock and reuse its token."""
+
+    def __init__(self):
+        self._tokens = {}  # key -> (token, expires_at on the monotonic clock)
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def _fresh(self, key):
+        entry = self._tokens.get(key)
+        if entry and time.monotonic() < entry[1] - TOKEN_REFRESH_MARGIN:
+            return entry[0]
+        return None
+
+    def get(self, key, fetch):
+        """Return a cached token for key, calling fetch() -> (token, expires_in) when stale."""
+        token = self._fresh(key)
+        if token:
+            return token
+        with self._guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            token = self._fresh(key)  # refreshed by another thread while we waited
+            if token:
+                return token
+            token, expires_in = fetch()
+            self._tokens[key] = (token, time.monotonic() + expires_in)
+            return token
+
+    def invalidate(self, key):
+        self._tokens.pop(key, None)
+
+
+_token_cache = _TokenCache()
+
+
 class MpesaClient:
     def __init__(self):
         self.consumer_key = "q8XQWxRqiqzr6HPsOPiFghU0gkRTSil8t0AVLA07C7N7HUMj"
@@ -17,15 +61,26 @@ class MpesaClient:
         self.base_url = os.getenv("MPESA_BASE_URL", "https://sandbox.safaricom.co.ke")
         self.callback_url = os.getenv("CALLBACK_URL")  # ✅ Matches your .env key
 
-    def get_access_token(self):
-        """Generate an access token from Safaricom API."""
+    @property
+    def _token_key(self):
+        return (self.base_url, self.consumer_key)
+
+    def _fetch_access_token(self):
+        """Generate an access token from Safaricom API. Returns (token, expires_in seconds)."""
         url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
-        resp = requests.get(url, auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret), timeout=10)
+        resp = get_session("MPESA").get(url, auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret), timeout=10)
         resp.raise_for_status()
-        return resp.json().get("access_token")
+        data = resp.json()
+        return data.get("access_token"), int(data.get("expires_in", 3599))
+
+    def get_access_token(self, force_refresh=False):
+        """Return a cached access token, fetching a new one only when it is close to expiry."""
+        if force_refresh:
+            _token_cache.invalidate(self._token_key)
+        return _token_cache.get(self._token_key, self._fetch_access_token)
 
-    def stk_push(self, phone_number, amount_kes, transaction_id):
-        """Initiate an STK push request."""
+    def stk_push(self, phone_number, amount_kes, transaction_id, account_reference=None):
+        """Initiate an STK push request. account_reference defaults to SUB<transaction_id>."""
         token = self.get_access_token()
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         password_str = f"{self.shortcode}{self.passkey}{timestamp}"
@@ -41,7 +96,7 @@ class MpesaClient:
             "PartyB": self.shortcode,
             "PhoneNumber": phone_number,
             "CallBackURL": self.callback_url,
-            "AccountReference": f"SUB{transaction_id}",
+            "AccountReference": account_reference or f"SUB{transaction_id}",
             "TransactionDesc": "WiFi Purchase"
         }
 
@@ -50,12 +105,21 @@ class MpesaClient:
             "Content-Type": "application/json"
         }
 
-        response = requests.post(
+        response = get_session("MPESA").post(
             f"{self.base_url}/mpesa/stkpush/v1/processrequest",
             json=payload,
             headers=headers,
             timeout=10
         )
+        if response.status_code == 401:
+            # token revoked or expired early: refresh once and retry
+            headers["Authorization"] = f"Bearer {self.get_access_token(force_refresh=True)}"
+            response = get_session("MPESA").post(
+                f"{self.base_url}/mpesa/stkpush/v1/processrequest",
+                json=payload,
+                headers=headers,
+                timeout=10
+            )
 
         print("DEBUG M-PESA RESPONSE:", response.text)
         response.raise_for_status()
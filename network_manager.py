@@ -1,96 +1,425 @@
-import requests
+import os
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import current_app
+from http_pool import get_session
 from datetime import datetime
+from urllib.parse import urlparse
+from requests import HTTPError
+from router_fleet import RouterRef, registry, router_for_user, run_on_routers
 
 # Example RouterOS (MikroTik) API endpoint and credentials
 MIKROTIK_API = "http://192.168.88.1/rest"
 MIKROTIK_USER = "Admin"
 MIKROTIK_PASS = "password"
+# concurrent REST calls against the default router (fleet routers use Router.max_concurrency)
+ROUTER_SYNC_WORKERS = int(os.getenv('ROUTER_SYNC_WORKERS', '8'))
+# minutes between scheduled fleet syncs (catches routers up on missed provisioning)
+ROUTER_SYNC_MINUTES = int(os.getenv('ROUTER_SYNC_MINUTES', '15'))
 
-def mikrotik_api_call(endpoint, data=None, method='GET'):
-    """Generic REST API call to Mikrotik RouterOS"""
-    url = f"{MIKROTIK_API}/{endpoint.strip('/')}"
-    auth = (MIKROTIK_USER, MIKROTIK_PASS)
+def default_router():
+    """The single router configured above, used when no Router is given."""
+    return RouterRef("default", None, urlparse(MIKROTIK_API).hostname, MIKROTIK_API,
+                     MIKROTIK_USER, MIKROTIK_PASS, ROUTER_SYNC_WORKERS)
+
+def mikrotik_api_call(endpoint, data=None, method='GET', params=None, router=None):
+    """Generic REST API call to Mikrotik RouterOS. params become the query string (GET filters)."""
+    router = router or default_router()
+    url = f"{router.rest_url}/{endpoint.strip('/')}"
+    auth = (router.username, router.password)
+    # pooled keep-alive session shared by all threads (see http_pool.py)
+    session = get_session("MIKROTIK")
     if method == 'GET':
-        r = requests.get(url, auth=auth, timeout=10)
+        r = session.get(url, params=params, auth=auth, timeout=10)
     elif method == 'POST':
-        r = requests.post(url, json=data, auth=auth, timeout=10)
+        r = session.post(url, json=data, auth=auth, timeout=10)
+    elif method == 'PATCH':
+        r = session.patch(url, json=data, auth=auth, timeout=10)
     elif method == 'DELETE':
-        r = requests.delete(url, auth=auth, timeout=10)
+        r = session.delete(url, params=params, auth=auth, timeout=10)
     else:
         raise ValueError("Unsupported method")
     r.raise_for_status()
     return r.json() if r.text else {}
 
+# -------------------------------
+# ROUTER .id INDEX
+# -------------------------------
+# tables we look entries up in, and the field that identifies an entry
+PPP_SECRETS = ("ppp/secret", "name")
+HOTSPOT_USERS = ("ip/hotspot/user", "name")
+DHCP_LEASES = ("ip/dhcp-server/lease", "mac-address")
+
+
+def _entry_key(table, value):
+    # RouterOS reports MACs upper-case
+    return value.upper() if table == DHCP_LEASES else value
+
+
+class RouterIndex:
+    """
+    name/MAC -> RouterOS .id per router and table. Filled by creates and
+    lookups and dropped on removes, so removing an entry normally costs a
+    one-field GET of the cached .id and a DELETE instead of dumping the
+    whole table.
+    """
+
+    def __init__(self):
+        self._ids = {}  # (router, table, key) -> .id
+        self._lock = threading.Lock()
+
+    def get(self, router, table, key):
+        return self._ids.get((router, table, key))
+
+    def set(self, router, table, key, entry_id):
+        with self._lock:
+            self._ids[(router, table, key)] = entry_id
+
+    def discard(self, router, table, key):
+        with self._lock:
+            self._ids.pop((router, table, key), None)
+
+    def load(self, router, table, entries):
+        """Replace everything known about one table with a full listing."""
+        path, field = table
+        with self._lock:
+            for k in [k for k in self._ids if k[0] == router and k[1] == table]:
+                del self._ids[k]
+            for entry in entries:
+                if entry.get(field) and entry.get('.id'):
+                    self._ids[(router, table, _entry_key(table, entry[field]))] = entry['.id']
+
+
+router_index = RouterIndex()
+
+
+def _lookup_id(table, key, router):
+    """Server-side filtered query for one entry's .id (small response, no full dump)."""
+    path, field = table
+    matches = mikrotik_api_call(f"/{path}", params={field: key, ".proplist": f".id,{field}"}, router=router)
+    if not matches:
+        router_index.discard(router.rest_url, table, key)
+        return None
+    entry_id = matches[0]['.id']
+    router_index.set(router.rest_url, table, key, entry_id)
+    return entry_id
+
+
+def _cached_id(table, key, router):
+    """The indexed .id for key, if the router still holds key under it. A reset or
+       restored router hands out .ids again, so a cached one is read back (one field)
+       before a DELETE is sent to it; a mismatch drops it from the index."""
+    entry_id = router_index.get(router.rest_url, table, key)
+    if entry_id is None:
+        return None
+    path, field = table
+    try:
+        entry = mikrotik_api_call(f"/{path}/{entry_id}", params={".proplist": field}, router=router)
+    except HTTPError as e:
+        if e.response is None or e.response.status_code not in (400, 404):
+            raise
+        entry = {}
+    if _entry_key(table, entry.get(field) or "") == key:
+        return entry_id
+    router_index.discard(router.rest_url, table, key)
+    return None
+
+
+def _find_id(table, key, router):
+    return _cached_id(table, key, router) or _lookup_id(table, key, router)
+
+
+def _record_created(table, key, result, router):
+    # "add" answers {"ret": "<.id>"}
+    if isinstance(result, dict) and result.get('ret'):
+        router_index.set(router.rest_url, table, _entry_key(table, key), result['ret'])
+    return result
+
+
+def _remove_entry(table, key, router=None):
+    """DELETE one entry by name/MAC; returns False when the router has no such entry."""
+    router = router or default_router()
+    path, _ = table
+    key = _entry_key(table, key)
+    entry_id = _find_id(table, key, router)
+    if entry_id is None:
+        return False
+    try:
+        mikrotik_api_call(f"/{path}/{entry_id}", method='DELETE', router=router)
+    except HTTPError as e:
+        # entry went away between the check and the DELETE: look it up again
+        if e.response is None or e.response.status_code not in (400, 404):
+            raise
+        router_index.discard(router.rest_url, table, key)
+        entry_id = _lookup_id(table, key, router)
+        if entry_id is None:
+            return False
+        mikrotik_api_call(f"/{path}/{entry_id}", method='DELETE', router=router)
+    router_index.discard(router.rest_url, table, key)
+    return True
+
 # -------------------------------
 # PPPoE MANAGEMENT
 # -------------------------------
-def create_pppoe_user(username, password, download_limit, upload_limit):
+def create_pppoe_user(username, password, download_limit, upload_limit, router=None, comment=None):
     """Create PPPoE user with bandwidth limits"""
     payload = {
         "name": username,
         "password": password,
         "profile": "default",
         "service": "pppoe",
-        "comment": f"Created {datetime.now().strftime('%Y-%m-%d %H:%M')}",
-        "limit-bytes-in": download_limit,
-        "limit-bytes-out": upload_limit
+        "comment": comment or f"Created {datetime.now().strftime('%Y-%m-%d %H:%M')}"
     }
-    return mikrotik_api_call("/ppp/secret/add", payload, method='POST')
+    if download_limit:
+        payload["limit-bytes-in"] = download_limit
+    if upload_limit:
+        payload["limit-bytes-out"] = upload_limit
+    router = router or default_router()
+    result = mikrotik_api_call("/ppp/secret/add", payload, method='POST', router=router)
+    return _record_created(PPP_SECRETS, username, result, router)
 
-def remove_pppoe_user(username):
+def remove_pppoe_user(username, router=None):
     """Remove PPPoE user"""
-    users = mikrotik_api_call("/ppp/secret/print", method='GET')
-    for user in users:
-        if user['name'] == username:
-            mikrotik_api_call(f"/ppp/secret/remove?=.id={user['.id']}", method='DELETE')
-            return True
-    return False
+    return _remove_entry(PPP_SECRETS, username, router)
 
 # -------------------------------
 # HOTSPOT MANAGEMENT
 # -------------------------------
-def create_hotspot_user(username, password, time_limit=None, data_limit=None):
+def create_hotspot_user(username, password, time_limit=None, data_limit=None, router=None, comment=None):
     """Create a hotspot user (voucher or phone-based)"""
     payload = {
         "name": username,
         "password": password,
         "server": "hotspot1",
         "profile": "default",
-        "comment": f"Hotspot user created {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        "comment": comment or f"Hotspot user created {datetime.now().strftime('%Y-%m-%d %H:%M')}"
     }
     if time_limit:
         payload["limit-uptime"] = time_limit
     if data_limit:
         payload["limit-bytes-total"] = data_limit
-    return mikrotik_api_call("/ip/hotspot/user/add", payload, method='POST')
+    router = router or default_router()
+    result = mikrotik_api_call("/ip/hotspot/user/add", payload, method='POST', router=router)
+    return _record_created(HOTSPOT_USERS, username, result, router)
 
-def remove_hotspot_user(username):
+def remove_hotspot_user(username, router=None):
     """Delete hotspot user"""
-    users = mikrotik_api_call("/ip/hotspot/user/print", method='GET')
-    for user in users:
-        if user['name'] == username:
-            mikrotik_api_call(f"/ip/hotspot/user/remove?=.id={user['.id']}", method='DELETE')
-            return True
-    return False
+    return _remove_entry(HOTSPOT_USERS, username, router)
 
 # -------------------------------
 # STATIC IP MANAGEMENT
 # -------------------------------
-def assign_static_ip(mac_address, ip_address, comment=""):
+def assign_static_ip(mac_address, ip_address, comment="", router=None):
     """Reserve a static IP for a specific MAC address"""
     payload = {
         "mac-address": mac_address,
         "address": ip_address,
         "comment": comment or f"Static IP for {mac_address}"
     }
-    return mikrotik_api_call("/ip/dhcp-server/lease/add", payload, method='POST')
+    router = router or default_router()
+    result = mikrotik_api_call("/ip/dhcp-server/lease/add", payload, method='POST', router=router)
+    return _record_created(DHCP_LEASES, mac_address, result, router)
 
-def remove_static_ip(mac_address):
+def remove_static_ip(mac_address, router=None):
     """Remove a static IP reservation"""
-    leases = mikrotik_api_call("/ip/dhcp-server/lease/print", method='GET')
-    for lease in leases:
-        if lease['mac-address'] == mac_address:
-            mikrotik_api_call(f"/ip/dhcp-server/lease/remove?=.id={lease['.id']}", method='DELETE')
-            return True
-    return False
+    return _remove_entry(DHCP_LEASES, mac_address, router)
+
+
+# -------------------------------
+# ROUTER SYNC (database -> router)
+# -------------------------------
+# password given to entries the sync creates. Local secrets are checked before RADIUS,
+# so there is no default: without it the sync creates nothing (RADIUS stays in charge)
+ROUTER_USER_PASSWORD = os.getenv('ROUTER_USER_PASSWORD') or None
+# comment on every entry the sync creates; only entries carrying it are ever changed or
+# removed by the sync (hand-made entries and vouchers from create_hotspot_user are not)
+SYNC_COMMENT = "wifinite-sync"
+# router fields compared per table; all are set from Plan.data_bytes
+SYNCED_FIELDS = {
+    PPP_SECRETS: ("limit-bytes-in", "limit-bytes-out"),
+    HOTSPOT_USERS: ("limit-bytes-total",),
+}
+
+
+def _is_managed(entry):
+    return entry.get("comment") == SYNC_COMMENT
+
+
+def _desired_fields(table, data_bytes):
+    # RouterOS reports every value as a string
+    value = str(int(data_bytes)) if data_bytes else None
+    return {field: value for field in SYNCED_FIELDS[table] if value is not None}
+
+
+def _empty_state():
+    return {PPP_SECRETS: {}, HOTSPOT_USERS: {}}
+
+
+def _desired_state():
+    """{router: {table: {username: data_bytes}}} for every active subscription, from one query."""
+    from models import db, Subscription, User, Plan
+
+    desired = defaultdict(_empty_state)
+    fleet = bool(registry.routers())
+    rows = (db.session.query(User.id, User.site, User.phone, Plan.connection_type, Plan.data_bytes)
+            .join(Subscription, Subscription.user_id == User.id)
+            .join(Plan, Subscription.plan_id == Plan.id)
+            .filter(Subscription.active.is_(True))
+            .order_by(Subscription.id))
+    tables = {"pppoe": PPP_SECRETS, "hotspot": HOTSPOT_USERS}
+    default = default_router()
+    for user_id, site, phone, connection_type, data_bytes in rows:
+        table = tables.get((connection_type or "").lower())
+        if table:
+            router = registry.router_for(user_id, site) if fleet else default
+            desired[router][table][str(phone)] = data_bytes
+    return desired
+
+
+def _router_state(table, router):
+    """One listing of a table with just the fields the sync needs; refreshes router_index."""
+    path, field = table
+    proplist = [".id", field, "comment", *SYNCED_FIELDS.get(table, ())]
+    entries = mikrotik_api_call(f"/{path}", params={".proplist": ",".join(proplist)}, router=router)
+    router_index.load(router.rest_url, table, entries)
+    return {_entry_key(table, e[field]): e for e in entries if e.get(field)}
+
+
+def _plan_sync(table, desired, present):
+    """Minimal adds, removes and field updates to make one table match `desired`."""
+    plan = {"add": [], "remove": [], "update": [], "unmanaged": []}
+    for name, data_bytes in desired.items():
+        entry = present.get(name)
+        want = _desired_fields(table, data_bytes)
+        if entry is None:
+            plan["add"].append((name, data_bytes))
+        elif not _is_managed(entry):
+            plan["unmanaged"].append(name)  # not created by the sync; left alone
+        else:
+            changes = {f: v for f, v in want.items() if entry.get(f) != v}
+            if changes:
+                plan["update"].append((name, entry[".id"], changes))
+    for name, entry in present.items():
+        if name not in desired and _is_managed(entry):
+            plan["remove"].append((name, entry[".id"]))
+    return plan
+
+
+def _sync_action(table, kind, item, router):
+    path, _ = table
+    if kind == "add":
+        name, data_bytes = item
+        limit = str(int(data_bytes)) if data_bytes else None
+        if table == PPP_SECRETS:
+            create_pppoe_user(name, ROUTER_USER_PASSWORD, limit, limit, router=router, comment=SYNC_COMMENT)
+        else:
+            create_hotspot_user(name, ROUTER_USER_PASSWORD, data_limit=limit, router=router,
+                                comment=SYNC_COMMENT)
+    elif kind == "remove":
+        name, entry_id = item
+        mikrotik_api_call(f"/{path}/{entry_id}", method='DELETE', router=router)
+        router_index.discard(router.rest_url, table, name)
+    else:
+        name, entry_id, changes = item
+        mikrotik_api_call(f"/{path}/{entry_id}", changes, method='PATCH', router=router)
+    return name
+
+
+def sync_router(dry_run=False, max_workers=None, router=None, desired=None):
+    """
+    Make one router's PPPoE secrets and hotspot users match the active
+    subscriptions mapped to it. Each table is listed once, diffed in memory
+    against one database query, and only the needed adds, removes and limit
+    updates are sent, at most router.max_concurrency at a time. Only entries
+    the sync created (tagged SYNC_COMMENT) are ever changed or removed, and
+    nothing is added unless ROUTER_USER_PASSWORD is set.
+    Static IP leases are reported but not changed, as the database holds no
+    MAC/IP assignments. Must run inside an app context unless `desired` is
+    given. Returns a report; nothing is written when dry_run.
+    """
+    started = time.monotonic()
+    if router is None and registry.routers():
+        raise ValueError("Routers are registered; use sync_fleet() or pass a router")
+    router = router or default_router()
+    if desired is None:
+        desired = _desired_state().get(router, _empty_state())
+    report = {"router": router.name, "dry_run": dry_run, "errors": []}
+    jobs = []
+
+    for label, table in (("pppoe", PPP_SECRETS), ("hotspot", HOTSPOT_USERS)):
+        plan = _plan_sync(table, desired[table], _router_state(table, router))
+        skipped = []
+        if not ROUTER_USER_PASSWORD and plan["add"]:
+            skipped, plan["add"] = [name for name, _ in plan["add"]], []
+            print(f"[WARN] ROUTER_USER_PASSWORD is not set; skipped {len(skipped)} {label} adds on {router.name}")
+        report[label] = {
+            "add": [name for name, _ in plan["add"]],
+            "skipped_no_password": skipped,
+            "remove": [name for name, _ in plan["remove"]],
+            "update": {name: changes for name, _, changes in plan["update"]},
+            "unmanaged": plan["unmanaged"],
+        }
+        for kind in ("add", "remove", "update"):
+            jobs.extend((router, _sync_action, (table, kind, item)) for item in plan[kind])
+
+    leases = _router_state(DHCP_LEASES, router)
+    report["static_ip"] = {
+        "leases": len(leases),
+        "managed": sum(1 for e in leases.values() if _is_managed(e)),
+    }
+
+    if not dry_run and jobs:
+        for (_, _, (table, kind, item)), _, error in run_on_routers(jobs, max_workers):
+            if error:
+                report["errors"].append({"table": table[0], "action": kind, "name": item[0], "error": error})
+
+    report["changes"] = len(jobs)
+    report["seconds"] = round(time.monotonic() - started, 2)
+    print(f"[DONE] Router sync {router.name}{' (dry run)' if dry_run else ''}: {len(jobs)} changes, "
+          f"{len(report['errors'])} errors in {report['seconds']}s")
+    return report
+
+
+def sync_fleet(dry_run=False, max_workers=None):
+    """
+    sync_router for every registered router (or the default one) in parallel,
+    from a single database query. One unreachable router only fails its own
+    report. Must run inside an app context. Returns {router name: report}.
+    """
+    desired = _desired_state()
+    routers = registry.routers() or [default_router()]
+    reports = {}
+    with ThreadPoolExecutor(max_workers=len(routers)) as pool:
+        futures = {
+            pool.submit(sync_router, dry_run, max_workers, router, desired.get(router, _empty_state())): router
+            for router in routers
+        }
+        for future in as_completed(futures):
+            router = futures[future]
+            try:
+                reports[router.name] = future.result()
+            except Exception as e:
+                reports[router.name] = {"router": router.name, "dry_run": dry_run, "errors": [{"error": str(e)}]}
+    return reports
+
+
+# -------------------------------
+# ROUTED PROVISIONING
+# -------------------------------
+def router_for(user):
+    """The router serving a User: from the registry, else the default router."""
+    return router_for_user(user) or default_router()
+
+
+def provision_many(calls, max_workers=None):
+    """
+    Run provisioning calls such as (user, create_hotspot_user, (phone, password))
+    on each user's router, routers in parallel and each within its own
+    max_concurrency. Returns [(call, result, error)] in call order.
+    """
+    calls = list(calls)
+    jobs = [(router_for(user), fn, args) for user, fn, args in calls]
+    return [(call, result, error)
+            for call, (_, result, error) in zip(calls, run_on_routers(jobs, max_workers))]
@@ -0,0 +1,153 @@
+# parallel_billing.py
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+from models import db, Subscription, BillingRun
+
+# number of worker processes used for a billing run; >1 opts in to process-pool billing
+BILLING_WORKERS = int(os.getenv('BILLING_WORKERS', '1'))
+# subscription ids per shard; shards are aligned to multiples of this so a rerun
+# produces the same ranges and resumes the BillingRun of each unfinished shard
+BILLING_SHARD_SIZE = int(os.getenv('BILLING_SHARD_SIZE', '10000'))
+
+
+def default_app_factory():
+    from schedular import create_app
+    return create_app()
+
+
+# ---- Sharding ----
+def shard_ranges(first_id: int, last_id: int, size: int=None):
+    """Inclusive ranges [k*size + 1, (k+1)*size] covering ids first_id..last_id.
+       Boundaries depend only on size, not on the current min/max id."""
+    size = size or BILLING_SHARD_SIZE
+    if first_id is None or last_id is None or last_id < first_id:
+        return []
+    first_shard, last_shard = (first_id - 1) // size, (last_id - 1) // size
+    return [(k * size + 1, (k + 1) * size) for k in range(first_shard, last_shard + 1)]
+
+
+def active_subscription_shards(size: int=None):
+    """Return aligned id-range shards covering every active subscription."""
+    first_id, last_id = db.session.query(
+        db.func.min(Subscription.id), db.func.max(Subscription.id)
+    ).filter(Subscription.active == True).one()
+    return shard_ranges(first_id, last_id, size)
+
+
+def unfinished_shards():
+    """Id ranges of shard BillingRuns that failed or never completed (oldest first)."""
+    rows = (db.session.query(BillingRun.first_subscription_id, BillingRun.last_subscription_id)
+            .filter(BillingRun.status != 'completed',
+                    BillingRun.first_subscription_id.isnot(None),
+                    BillingRun.last_subscription_id.isnot(None))
+            .order_by(BillingRun.id))
+    ranges = []
+    for id_range in rows:
+        if tuple(id_range) not in ranges:
+            ranges.append(tuple(id_range))
+    return ranges
+
+
+# ---- Worker ----
+def bill_shard(app_factory, id_range, run_date: datetime, batch_size: int=None):
+    """Bill one id range. Runs in a worker process with its own app context and DB session."""
+    from billing import generate_invoices_for_date
+
+    started = time.monotonic()
+    result = {
+        'id_range': id_range,
+        'invoice_ids': [],
+        'invoices_created': 0,
+        'error': None,
+    }
+    app = app_factory()
+    with app.app_context():
+        try:
+            invoices = generate_invoices_for_date(run_date, batch_size=batch_size, id_range=id_range)
+            result['invoice_ids'] = [inv.id for inv in invoices]
+            result['invoices_created'] = len(invoices)
+        except Exception as e:
+            db.session.rollback()
+            result['error'] = f"{type(e).__name__}: {e}"
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+    result['seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+# ---- Driver ----
+def _overlaps(a, b):
+    return a[0] <= b[1] and b[0] <= a[1]
+
+
+def run_parallel_billing(run_date: datetime=None, workers: int=None, batch_size: int=None, app_factory=None):
+    """Bill all active subscriptions with a process pool, one id-range shard per task.
+       Unfinished shard runs left by earlier runs (e.g. from a different BILLING_SHARD_SIZE)
+       are resumed first; the aligned shards then pick up their own unfinished runs.
+       Must be called inside an app context (used to compute the shards).
+       Returns a merged run report:
+         {run_date, workers, shards, invoices_created, invoice_ids, failures, seconds}
+    """
+    now = run_date or datetime.now(timezone.utc)
+    workers = workers or BILLING_WORKERS
+    app_factory = app_factory or default_app_factory
+    started = time.monotonic()
+
+    shards = active_subscription_shards()
+    leftovers = [r for r in unfinished_shards() if r not in shards]
+    # workers open their own connections; don't hold ours while they run
+    db.session.remove()
+    db.engine.dispose()
+
+    report = {
+        'run_date': now,
+        'workers': workers,
+        'shards': [],
+        'invoices_created': 0,
+        'invoice_ids': [],
+        'failures': [],
+    }
+    # leftover ranges can overlap each other and the aligned shards, so each
+    # wave only holds non-overlapping ranges and waves run one after another
+    waves = []
+    for id_range in leftovers:
+        for wave in waves:
+            if not any(_overlaps(id_range, other) for other in wave):
+                wave.append(id_range)
+                break
+        else:
+            waves.append([id_range])
+    if shards:
+        waves.append(shards)
+    # spawn, not fork: this runs inside the scheduler while other jobs' threads may hold
+    # locks (stdout, connection pools) that a forked child would inherit held
+    mp_context = multiprocessing.get_context('spawn')
+    for wave in waves:
+        with ProcessPoolExecutor(max_workers=min(workers, len(wave)), mp_context=mp_context) as pool:
+            futures = {
+                pool.submit(bill_shard, app_factory, id_range, now, batch_size): id_range
+                for id_range in wave
+            }
+            for future in as_completed(futures):
+                id_range = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the worker process itself died
+                    result = {'id_range': id_range, 'invoice_ids': [], 'invoices_created': 0,
+                              'error': f"{type(e).__name__}: {e}", 'seconds': None}
+                report['shards'].append(result)
+                report['invoices_created'] += result['invoices_created']
+                report['invoice_ids'].extend(result['invoice_ids'])
+                if result['error']:
+                    report['failures'].append({'id_range': id_range, 'error': result['error']})
+                    print(f"[ERROR] Billing shard {id_range} failed: {result['error']}")
+
+    report['shards'].sort(key=lambda r: r['id_range'])
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
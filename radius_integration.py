@@ -1,50 +1,235 @@
-import mysql.connector
+# radius_integration.py
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from mysql.connector import pooling
+
+RADIUS_DB = {
+    'host': os.getenv('RADIUS_DB_HOST', 'localhost'),
+    'user': os.getenv('RADIUS_DB_USER', 'radius_user'),
+    'password': os.getenv('RADIUS_DB_PASSWORD', 'your_db_password'),
+    'database': os.getenv('RADIUS_DB_NAME', 'radius'),
+}
+# connections kept open to the RADIUS database (mysql.connector allows at most 32)
+RADIUS_POOL_SIZE = min(int(os.getenv('RADIUS_POOL_SIZE', '8')), pooling.CNX_POOL_MAXSIZE)
+# seconds to wait for a free connection before giving up
+RADIUS_POOL_TIMEOUT = float(os.getenv('RADIUS_POOL_TIMEOUT', '10'))
+# connections idle longer than this are pinged (and reconnected) before use
+RADIUS_PING_AFTER = float(os.getenv('RADIUS_PING_AFTER', '30'))
+
+_pool = None
+_pool_lock = threading.Lock()
+# mysql.connector raises as soon as the pool is empty; callers queue here instead
+_slots = threading.BoundedSemaphore(RADIUS_POOL_SIZE)
+_last_used = {}  # connection_id -> monotonic time it was returned
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name='radius',
+                    pool_size=RADIUS_POOL_SIZE,
+                    pool_reset_session=False,
+                    autocommit=False,
+                    **RADIUS_DB
+                )
+    return _pool
+
+
+def _checkout():
+    if not _slots.acquire(timeout=RADIUS_POOL_TIMEOUT):
+        raise TimeoutError(f"No RADIUS connection free after {RADIUS_POOL_TIMEOUT}s")
+    try:
+        connection = _get_pool().get_connection()
+        # health check: only connections that sat idle pay for a ping
+        if time.monotonic() - _last_used.pop(connection.connection_id, 0) > RADIUS_PING_AFTER:
+            connection.ping(reconnect=True, attempts=2, delay=0.2)
+        return connection
+    except Exception:
+        _slots.release()
+        raise
+
+
+def _checkin(connection):
+    try:
+        _last_used[connection.connection_id] = time.monotonic()
+        connection.close()  # returns it to the pool
+    finally:
+        _slots.release()
+
+
+@contextmanager
+def radius_cursor(prepared=True):
+    """
+    Yield a cursor on a pooled RADIUS connection (prepared statements unless
+    prepared=False). Everything executed inside the block is one transaction:
+    committed on success, rolled back on error.
+    """
+    connection = _checkout()
+    cursor = connection.cursor(prepared=prepared)
+    try:
+        yield cursor
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        _checkin(connection)
+
+
+# ---- Statements ----
+DELETE_CHECK = "DELETE FROM radcheck WHERE username = %s AND attribute = %s"
+INSERT_CHECK = "INSERT INTO radcheck (username, attribute, op, value) VALUES (%s, %s, ':=', %s)"
+DELETE_REPLY = "DELETE FROM radreply WHERE username = %s AND attribute = %s"
+INSERT_REPLY = "INSERT INTO radreply (username, attribute, op, value) VALUES (%s, %s, ':=', %s)"
+
+
+def rate_limit_value(download_speed, upload_speed):
+    """Mikrotik-Rate-Limit value (Kbps) for speeds given in Mbps."""
+    return f"{int(download_speed*1024)}/{int(upload_speed*1024)}"
+
 
 def grant_wifi_access(username, password="1234"):
-    connection = mysql.connector.connect(
-        host="localhost",
-        user="radius_user",
-        password="your_db_password",
-        database="radius"
-    )
-    cursor = connection.cursor()
-
-    cursor.execute(
-        "INSERT INTO radcheck (username, attribute, op, value) VALUES (%s, 'Cleartext-Password', ':=', %s)",
-        (username, password)
-    )
-
-    connection.commit()
-    cursor.close()
-    connection.close()
+    """Set the user's RADIUS password and lift any access block."""
+    with radius_cursor() as cursor:
+        cursor.execute(DELETE_CHECK, (username, 'Cleartext-Password'))
+        cursor.execute(INSERT_CHECK, (username, 'Cleartext-Password', password))
+        cursor.execute(DELETE_CHECK, (username, 'Auth-Type'))
     print(f"✅ Wi-Fi access granted for {username}")
 
-# radius_integration.py
+
+def revoke_wifi_access(username):
+    """Reject further RADIUS logins for the user; their password is kept."""
+    with radius_cursor() as cursor:
+        cursor.execute(DELETE_CHECK, (username, 'Auth-Type'))
+        cursor.execute(INSERT_CHECK, (username, 'Auth-Type', 'Reject'))
+
+
 def disable_user_access(phone, connection_type):
+    revoke_wifi_access(str(phone))
     print(f"[RADIUS] Disabled {connection_type} access for {phone}")
-    # TODO: Implement actual RADIUS or MikroTik API calls here
+
 
 def enable_user_access(phone, connection_type):
+    with radius_cursor() as cursor:
+        cursor.execute(DELETE_CHECK, (str(phone), 'Auth-Type'))
     print(f"[RADIUS] Enabled {connection_type} access for {phone}")
-    # TODO: Implement actual RADIUS or MikroTik API calls here
+
 
 def apply_bandwidth_limits(username, download_speed, upload_speed):
     """
     Pushes bandwidth limits to RADIUS attributes.
     Example uses Mikrotik attributes.
     """
-    from your_database_config import db_connection
-
-    cursor = db_connection.cursor()
-    cursor.execute("""
-        INSERT INTO radreply (username, attribute, op, value)
-        VALUES
-        (%s, 'Mikrotik-Rate-Limit', ':=', %s)
-        ON DUPLICATE KEY UPDATE value=%s
-    """, (
-        username,
-        f"{int(download_speed*1024)}/{int(upload_speed*1024)}",  # Kbps
-        f"{int(download_speed*1024)}/{int(upload_speed*1024)}"
-    ))
-    db_connection.commit()
-    cursor.close()
\ No newline at end of file
+    # radreply has no unique key on (username, attribute), so replace the row
+    with radius_cursor() as cursor:
+        cursor.execute(DELETE_REPLY, (username, 'Mikrotik-Rate-Limit'))
+        cursor.execute(INSERT_REPLY, (username, 'Mikrotik-Rate-Limit',
+                                      rate_limit_value(download_speed, upload_speed)))
+
+
+# ---- Batched provisioning ----
+# users per multi-row statement
+RADIUS_BATCH_CHUNK = int(os.getenv('RADIUS_BATCH_CHUNK', '500'))
+
+
+def _placeholders(n, row="%s"):
+    return ", ".join([row] * n)
+
+
+class RadiusBatch:
+    """
+    Collects grant/enable/revoke and rate-limit changes and writes them with
+    multi-row statements in a single transaction on flush(). Only the last
+    access change queued for a user counts.
+
+        batch = RadiusBatch()
+        for sub in expired:
+            batch.revoke(str(sub.user.phone))
+        results = batch.flush()   # {username: None or error message}
+    """
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or RADIUS_BATCH_CHUNK
+        self._access = OrderedDict()  # username -> ('grant', password) | ('enable',) | ('revoke',)
+        self._limits = OrderedDict()  # username -> Mikrotik-Rate-Limit value
+
+    def grant(self, username, password="1234"):
+        self._access[username] = ('grant', password)
+
+    def enable(self, username):
+        self._access[username] = ('enable',)
+
+    def revoke(self, username):
+        self._access[username] = ('revoke',)
+
+    def set_rate_limit(self, username, download_speed, upload_speed):
+        self._limits[username] = rate_limit_value(download_speed, upload_speed)
+
+    def __len__(self):
+        return len(set(self._access) | set(self._limits))
+
+    def _chunks(self, items):
+        items = list(items)
+        for start in range(0, len(items), self.chunk_size):
+            yield items[start:start + self.chunk_size]
+
+    def _write(self, cursor, access, limits):
+        passwords = [(u, op[1]) for u, op in access.items() if op[0] == 'grant']
+        rejects = [u for u, op in access.items() if op[0] == 'revoke']
+
+        for users in self._chunks(access):
+            cursor.execute(f"DELETE FROM radcheck WHERE attribute = 'Auth-Type' AND username IN ({_placeholders(len(users))})", users)
+        for rows in self._chunks(passwords):
+            users = [u for u, _ in rows]
+            cursor.execute(f"DELETE FROM radcheck WHERE attribute = 'Cleartext-Password' AND username IN ({_placeholders(len(users))})", users)
+            cursor.execute("INSERT INTO radcheck (username, attribute, op, value) VALUES "
+                           + _placeholders(len(rows), "(%s, 'Cleartext-Password', ':=', %s)"),
+                           [v for row in rows for v in row])
+        for users in self._chunks(rejects):
+            cursor.execute("INSERT INTO radcheck (username, attribute, op, value) VALUES "
+                           + _placeholders(len(users), "(%s, 'Auth-Type', ':=', 'Reject')"), users)
+        for rows in self._chunks(limits.items()):
+            users = [u for u, _ in rows]
+            cursor.execute(f"DELETE FROM radreply WHERE attribute = 'Mikrotik-Rate-Limit' AND username IN ({_placeholders(len(users))})", users)
+            cursor.execute("INSERT INTO radreply (username, attribute, op, value) VALUES "
+                           + _placeholders(len(rows), "(%s, 'Mikrotik-Rate-Limit', ':=', %s)"),
+                           [v for row in rows for v in row])
+
+    def flush(self):
+        """
+        Apply everything queued in one transaction and clear the batch.
+        If the transaction fails, each user is retried on their own so one bad
+        row does not fail the rest. Returns {username: None on success, else the error}.
+        """
+        access, limits = self._access, self._limits
+        self._access, self._limits = OrderedDict(), OrderedDict()
+        users = list(OrderedDict.fromkeys([*access, *limits]))
+        if not users:
+            return {}
+
+        try:
+            with radius_cursor(prepared=False) as cursor:
+                self._write(cursor, access, limits)
+            return dict.fromkeys(users)
+        except Exception as e:
+            print(f"[WARN] RADIUS batch of {len(users)} users failed ({e}), retrying per user")
+
+        results = {}
+        for user in users:
+            try:
+                with radius_cursor(prepared=False) as cursor:
+                    self._write(cursor,
+                                {user: access[user]} if user in access else {},
+                                {user: limits[user]} if user in limits else {})
+                results[user] = None
+            except Exception as e:
+                results[user] = str(e)
+        return results
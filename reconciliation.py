@@ -0,0 +1,220 @@
+# reconciliation.py
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+
+from models import db, Invoice, Transaction
+
+# completed payments younger than this are (re)considered on every run
+RECONCILE_LOOKBACK_HOURS = int(os.getenv('RECONCILE_LOOKBACK_HOURS', '48'))
+# a payment without a reference may settle an invoice generated up to this long before it
+RECONCILE_MATCH_WINDOW_DAYS = int(os.getenv('RECONCILE_MATCH_WINDOW_DAYS', '35'))
+# ... or shortly after it (customer paid just before the invoice was generated)
+RECONCILE_EARLY_GRACE = timedelta(hours=int(os.getenv('RECONCILE_EARLY_GRACE_HOURS', '24')))
+# rows per IN (...) lookup and per executemany update
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', '500'))
+
+OPEN_INVOICE_STATUSES = ('Unpaid', 'Overdue')
+
+
+def _amount_key(amount) -> int:
+    # STK pushes send int(amount), so that is what a completed payment carries
+    return int(amount)
+
+
+def _invoice_id_from_reference(reference):
+    if reference and reference.startswith('INV') and reference[3:].isdigit():
+        return int(reference[3:])
+    return None
+
+
+def _chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _load_transactions(since):
+    """Completed payments not yet linked to an invoice, as plain tuples. Payments with
+       any other reference (e.g. SUB<id> plan purchases) are not invoice payments; only
+       payments recorded without any reference are left for amount matching."""
+    return (db.session.query(Transaction.id, Transaction.user_id, Transaction.amount,
+                             Transaction.account_reference, Transaction.timestamp)
+            .filter(Transaction.status == 'Completed',
+                    Transaction.invoice_id.is_(None),
+                    Transaction.timestamp >= since,
+                    db.or_(Transaction.account_reference.is_(None),
+                           Transaction.account_reference.like('INV%')))
+            .order_by(Transaction.id)
+            .all())
+
+
+def _load_open_invoices(user_ids, invoice_ids, batch_size):
+    """Open invoices for the paying users plus any invoice named in a reference, keyed by id."""
+    columns = (Invoice.id, Invoice.user_id, Invoice.amount, Invoice.generated_at)
+    invoices = {}
+    for column, keys in ((Invoice.user_id, user_ids), (Invoice.id, invoice_ids)):
+        for chunk in _chunks(sorted(keys), batch_size):
+            for row in (db.session.query(*columns)
+                        .filter(column.in_(chunk), Invoice.status.in_(OPEN_INVOICE_STATUSES))):
+                invoices[row.id] = row
+    return invoices
+
+
+def _match_by_reference(transactions, invoices, matches, unmatched):
+    """Hash join on the INV<id> AccountReference. Returns the payments without
+       a reference, which are left to _match_by_user_amount."""
+    remaining = []
+    for txn in transactions:
+        if txn.account_reference is None:
+            remaining.append(txn)
+            continue
+        invoice_id = _invoice_id_from_reference(txn.account_reference)
+        invoice = invoices.get(invoice_id) if invoice_id is not None else None
+        if invoice_id is None:
+            unmatched.append((txn, 'bad reference'))
+        elif invoice is None:
+            unmatched.append((txn, 'invoice not open'))
+        elif _amount_key(invoice.amount) != _amount_key(txn.amount):
+            unmatched.append((txn, 'amount mismatch'))
+        else:
+            matches.append((txn, invoice))
+            del invoices[invoice_id]
+    return remaining
+
+
+def _match_by_user_amount(transactions, invoices, window, matches, unmatched):
+    """
+    Partition both sides on (user_id, amount), sort each partition by time and
+    merge: every payment settles the oldest open invoice generated within
+    `window` before it (or RECONCILE_EARLY_GRACE after it).
+    """
+    txn_groups = defaultdict(list)
+    for txn in transactions:
+        if txn.user_id is None:
+            unmatched.append((txn, 'no user'))
+        else:
+            txn_groups[(txn.user_id, _amount_key(txn.amount))].append(txn)
+    invoice_groups = defaultdict(list)
+    for invoice in invoices.values():
+        invoice_groups[(invoice.user_id, _amount_key(invoice.amount))].append(invoice)
+
+    for key, txns in txn_groups.items():
+        txns.sort(key=lambda t: (t.timestamp, t.id))
+        candidates = sorted(invoice_groups.get(key, ()), key=lambda i: (i.generated_at, i.id))
+        i = 0
+        for txn in txns:
+            # invoices too old for this payment are too old for every later one
+            while i < len(candidates) and candidates[i].generated_at < txn.timestamp - window:
+                i += 1
+            if i < len(candidates) and candidates[i].generated_at <= txn.timestamp + RECONCILE_EARLY_GRACE:
+                matches.append((txn, candidates[i]))
+                i += 1
+            else:
+                unmatched.append((txn, 'no open invoice in window'))
+
+
+def _apply(matches, batch_size):
+    """Link transactions and mark invoices paid with batched executemany UPDATEs.
+       Returns the matches skipped because their invoice was settled in the meantime."""
+    txn_table, invoice_table = Transaction.__table__, Invoice.__table__
+    link_stmt = (txn_table.update()
+                 .where(txn_table.c.id == bindparam('txn_id'))
+                 .where(txn_table.c.invoice_id.is_(None))
+                 .values(invoice_id=bindparam('invoice_id')))
+    # an invoice paid by hand in the meantime is left alone
+    pay_stmt = (invoice_table.update()
+                .where(invoice_table.c.id == bindparam('invoice_id'))
+                .where(db.or_(*(invoice_table.c.status == status for status in OPEN_INVOICE_STATUSES)))
+                .values(status='Paid', paid_at=bindparam('paid_at')))
+
+    skipped = []
+    for chunk in _chunks(matches, batch_size):
+        try:
+            # lock the chunk's invoices and only pay (and link) those still open, so a
+            # payment is never linked to an invoice something else already settled
+            still_open = {invoice_id for (invoice_id,) in
+                          db.session.query(Invoice.id)
+                          .filter(Invoice.id.in_([inv.id for _, inv in chunk]),
+                                  Invoice.status.in_(OPEN_INVOICE_STATUSES))
+                          .with_for_update()}
+            skipped.extend(m for m in chunk if m[1].id not in still_open)
+            chunk = [m for m in chunk if m[1].id in still_open]
+            if chunk:
+                conn = db.session.connection()
+                conn.execute(pay_stmt, [{'invoice_id': inv.id, 'paid_at': txn.timestamp} for txn, inv in chunk])
+                conn.execute(link_stmt, [{'txn_id': txn.id, 'invoice_id': inv.id} for txn, inv in chunk])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return skipped
+
+
+def reconcile_payments(now: datetime=None, lookback_hours: int=None, window_days: int=None, batch_size: int=None):
+    """
+    Match completed M-Pesa transactions to open invoices in bulk and mark them paid.
+    Payments carrying an INV<id> account reference are joined on it directly;
+    payments recorded without any reference are matched on (user, amount) within
+    the time window. Payments with any other reference are left alone. Everything is read
+    in a few set-based queries and written with batched UPDATEs. Safe to re-run.
+    Must run inside an app context. Returns a report with the unmatched payments.
+    """
+    now = now or datetime.utcnow()
+    lookback = timedelta(hours=RECONCILE_LOOKBACK_HOURS if lookback_hours is None else lookback_hours)
+    window = timedelta(days=RECONCILE_MATCH_WINDOW_DAYS if window_days is None else window_days)
+    batch_size = batch_size or RECONCILE_BATCH_SIZE
+
+    transactions = _load_transactions(now - lookback)
+    invoices = _load_open_invoices(
+        {t.user_id for t in transactions if t.user_id is not None and t.account_reference is None},
+        {i for i in (_invoice_id_from_reference(t.account_reference) for t in transactions) if i is not None},
+        batch_size,
+    )
+    db.session.commit()
+
+    matches, unmatched = [], []
+    remaining = _match_by_reference(transactions, invoices, matches, unmatched)
+    by_reference = len(matches)
+    _match_by_user_amount(remaining, invoices, window, matches, unmatched)
+    skipped = _apply(matches, batch_size)
+    if skipped:
+        skipped_txn_ids = {txn.id for txn, _ in skipped}
+        matches = [m for m in matches if m[0].id not in skipped_txn_ids]
+        by_reference = len([m for m in matches if m[0].account_reference is not None])
+        unmatched.extend((txn, 'invoice settled meanwhile') for txn, _ in skipped)
+
+    matched_invoice_ids = {inv.id for _, inv in matches}
+    report = {
+        'transactions': len(transactions),
+        'matched': len(matches),
+        'matched_by_reference': by_reference,
+        'matched_by_amount': len(matches) - by_reference,
+        'unmatched_transactions': [
+            {'id': txn.id, 'user_id': txn.user_id, 'amount': txn.amount,
+             'account_reference': txn.account_reference, 'reason': reason}
+            for txn, reason in unmatched
+        ],
+        'open_invoices_unmatched': len([i for i in invoices if i not in matched_invoice_ids]),
+    }
+    print(f"[DONE] Reconciliation: {report['matched']} of {report['transactions']} payments matched "
+          f"({by_reference} by reference), {len(unmatched)} unmatched")
+    return report
+
+
+if __name__ == '__main__':
+    import json
+    import argparse
+    from schedular import create_app
+
+    parser = argparse.ArgumentParser(description="Match completed payments to open invoices")
+    parser.add_argument('--lookback-hours', type=int, default=None)
+    parser.add_argument('--window-days', type=int, default=None)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        print(json.dumps(reconcile_payments(lookback_hours=args.lookback_hours,
+                                            window_days=args.window_days), indent=2))
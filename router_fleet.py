@@ -0,0 +1,153 @@
+# router_fleet.py
+import os
+import time
+import bisect
+import hashlib
+import threading
+from collections import namedtuple, defaultdict, deque
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
+
+from models import Router
+
+# seconds the router list is reused before it is re-read from the database
+ROUTER_REGISTRY_TTL = float(os.getenv('ROUTER_REGISTRY_TTL', '60'))
+# points per router on the hash ring; more points = more even spread
+RING_REPLICAS = 100
+# upper bound on threads used by run_on_routers across the whole fleet
+FLEET_MAX_WORKERS = int(os.getenv('FLEET_MAX_WORKERS', '64'))
+
+# plain copy of a Router row, safe to hand to worker threads
+RouterRef = namedtuple('RouterRef', 'name site host rest_url username password max_concurrency')
+
+
+def router_ref(router: Router) -> RouterRef:
+    return RouterRef(
+        name=router.name,
+        site=router.site,
+        host=router.host,
+        rest_url=(router.rest_url or f"http://{router.host}/rest").rstrip('/'),
+        username=router.username,
+        password=router.password,
+        max_concurrency=router.max_concurrency or 4,
+    )
+
+
+# ---- Consistent hashing ----
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent-hash ring: adding or removing a router only remaps its own share of subscribers."""
+
+    def __init__(self, routers, replicas=RING_REPLICAS):
+        points = sorted((_hash(f"{r.name}#{i}"), r) for r in routers for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._routers = [r for _, r in points]
+
+    def get(self, key):
+        if not self._routers:
+            return None
+        i = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._routers[i]
+
+
+# ---- Registry ----
+class RouterRegistry:
+    """Active routers and their rings, re-read from the database every ROUTER_REGISTRY_TTL seconds."""
+
+    def __init__(self, ttl=ROUTER_REGISTRY_TTL):
+        self.ttl = ttl
+        self._loaded_at = None
+        self._routers = []
+        self._ring = HashRing([])
+        self._site_rings = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        routers = [router_ref(r) for r in Router.query.filter_by(active=True).order_by(Router.id)]
+        by_site = defaultdict(list)
+        for r in routers:
+            if r.site:
+                by_site[r.site].append(r)
+        with self._lock:
+            self._routers = routers
+            self._ring = HashRing(routers)
+            self._site_rings = {site: HashRing(rs) for site, rs in by_site.items()}
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            self._refresh()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def routers(self):
+        self._ensure_loaded()
+        return list(self._routers)
+
+    def router_for(self, user_id, site=None):
+        """The user's router: hashed among their site's routers, or across the fleet
+           when they have no site or it has no router. None when the registry is empty."""
+        self._ensure_loaded()
+        ring = self._site_rings.get(site) if site else None
+        return (ring or self._ring).get(user_id)
+
+
+registry = RouterRegistry()
+
+
+def router_for_user(user):
+    return registry.router_for(user.id, user.site)
+
+
+# ---- Parallel execution ----
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def router_slots(router: RouterRef) -> threading.BoundedSemaphore:
+    """Process-wide limit on calls in flight against one router."""
+    with _slots_lock:
+        slots = _slots.get(router.name)
+        if slots is None:
+            slots = _slots[router.name] = threading.BoundedSemaphore(router.max_concurrency)
+        return slots
+
+
+def run_on_routers(jobs, max_workers=None):
+    """
+    Run (router, fn, args) jobs as fn(*args, router=router). Each router's jobs
+    are drained by at most max_concurrency of its own workers, so a slow router
+    only holds up its own queue. Returns [(job, result, error)] in job order.
+    """
+    jobs = list(jobs)
+    queues = defaultdict(deque)
+    for index, job in enumerate(jobs):
+        queues[job[0]].append(index)
+    results = [None] * len(jobs)
+
+    def drain(router, queue):
+        slots = router_slots(router)
+        while True:
+            try:
+                index = queue.popleft()  # deque pops are thread-safe
+            except IndexError:
+                return
+            _, fn, args = jobs[index]
+            with slots:
+                try:
+                    results[index] = (jobs[index], fn(*args, router=router), None)
+                except Exception as e:
+                    results[index] = (jobs[index], None, str(e))
+
+    # round-robin over routers so every router gets a worker before any gets a second
+    per_router = [[(router, queue)] * min(router.max_concurrency, len(queue))
+                  for router, queue in queues.items()]
+    workers = [w for round_ in zip_longest(*per_router) for w in round_ if w]
+    with ThreadPoolExecutor(max_workers=min(max_workers or FLEET_MAX_WORKERS, max(len(workers), 1))) as pool:
+        for router, queue in workers:
+            pool.submit(drain, router, queue)
+    return results
@@ -3,12 +3,21 @@ import os
 from datetime import datetime, timezone
 from flask import Flask
 from apscheduler.schedulers.background import BackgroundScheduler
+from extensions import DATABASE_URL
 from models import db, User, Plan, Subscription, Usage, Invoice
 from billing import generate_invoices_for_date
+from parallel_billing import BILLING_WORKERS, run_parallel_billing
+from auto_renew import dispatch_pending_charges
+from usage_retention import compact_usage
+from callback_worker import process_callback_events
+from reconciliation import reconcile_payments
+from usage_poller import USAGE_POLL_SECONDS, poll_usage
+from bandwidth_control import prune_access_changes
+from network_manager import ROUTER_SYNC_MINUTES, sync_fleet
 
 def create_app():
     app = Flask(__name__)
-    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///billing.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL  # same database as app.py
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
     return app
@@ -18,6 +27,20 @@ def start_scheduler(app):
     scheduler.add_job(func=lambda: run_billing_job(app), trigger="cron", hour=0, minute=5)  # daily at 00:05
     # optional: add hourly job for usage-based microbilling
     scheduler.add_job(func=lambda: run_billing_job(app, hourly=True), trigger="cron", minute=0)  # hourly
+    # send queued auto-renew STK pushes outside the billing run
+    scheduler.add_job(func=lambda: run_charge_dispatcher(app), trigger="interval", minutes=1)
+    # compact raw usage past the retention window
+    scheduler.add_job(func=lambda: run_usage_retention(app), trigger="cron", hour=3, minute=30)
+    # apply queued M-Pesa callbacks
+    scheduler.add_job(func=lambda: run_callback_worker(app), trigger="interval", seconds=5)
+    # settle open invoices from completed payments
+    scheduler.add_job(func=lambda: run_reconciliation(app), trigger="interval", minutes=10)
+    # turn router session counters into Usage rows
+    scheduler.add_job(func=lambda: run_usage_poller(app), trigger="interval", seconds=USAGE_POLL_SECONDS)
+    # trim the cross-process access cache invalidation log
+    scheduler.add_job(func=lambda: run_access_change_prune(app), trigger="interval", minutes=10)
+    # bring routers in line with the database (provisioning missed while a router was down)
+    scheduler.add_job(func=lambda: run_router_sync(app), trigger="interval", minutes=ROUTER_SYNC_MINUTES)
     scheduler.start()
     print("Scheduler started")
 
@@ -25,8 +48,14 @@ def run_billing_job(app, hourly=False):
     with app.app_context():
         now = datetime.now(timezone.utc)
         print("Billing job running at", now.isoformat(), "hourly=", hourly)
-        invoices = generate_invoices_for_date(now)
-        print(f"Created {len(invoices)} invoices")
+        if BILLING_WORKERS > 1:
+            report = run_parallel_billing(now)
+            print(f"Created {report['invoices_created']} invoices in {len(report['shards'])} shards "
+                  f"({report['seconds']}s, {len(report['failures'])} failed shards)")
+            invoices = Invoice.query.filter(Invoice.id.in_(report['invoice_ids'])).all()
+        else:
+            invoices = generate_invoices_for_date(now)
+            print(f"Created {len(invoices)} invoices")
         # optionally: generate HTML invoices for each
         from invoice_utils import invoice_to_html
         for inv in invoices:
@@ -35,6 +64,36 @@ def run_billing_job(app, hourly=False):
             print("Saved invoice HTML:", path)
             # optionally: call payment automation here
 
+def run_charge_dispatcher(app):
+    with app.app_context():
+        dispatch_pending_charges()
+
+def run_usage_retention(app):
+    with app.app_context():
+        compact_usage()
+
+def run_callback_worker(app):
+    with app.app_context():
+        process_callback_events()
+
+def run_reconciliation(app):
+    with app.app_context():
+        reconcile_payments()
+
+def run_usage_poller(app):
+    with app.app_context():
+        poll_usage()
+
+def run_access_change_prune(app):
+    with app.app_context():
+        prune_access_changes()
+
+def run_router_sync(app):
+    with app.app_context():
+        reports = sync_fleet()
+        failed = [name for name, report in reports.items() if report['errors']]
+        print(f"Router sync: {len(reports)} routers ({len(failed)} with errors)")
+
 if __name__ == '__main__':
     app = create_app()
     with app.app_context():
@@ -1,9 +1,8 @@
 from datetime import datetime, timedelta
 from models import Subscription, Invoice, User, Plan
-from mpesa_clients import MpesaClient
-from radius_integration import disable_user_access, enable_user_access
-
-mpesa = MpesaClient()
+from billing import subscription_batches, schedule_next_bill
+from auto_renew import queue_auto_renew
+from radius_integration import RadiusBatch
 
 
 def calculate_usage_charges(subscription):
@@ -34,13 +33,16 @@ def calculate_prorated_charge(subscription, old_plan, new_plan):
     return round(prorated_charge, 2)
 
 
-def process_billing_cycle(app=None, db=None):
+def process_billing_cycle(app=None, db=None, batch_size=None):
     """
     Automated billing process:
       - Flat, data-based, and time-based billing
       - Pro-rated mid-cycle billing
-      - M-Pesa STK push auto-renew
+      - M-Pesa STK push auto-renew (queued, see auto_renew.py)
       - Access control (Hotspot/PPPoE)
+
+    Subscriptions are streamed in chunks of batch_size (default BILLING_BATCH_SIZE)
+    and each chunk's invoices are committed together.
     """
 
     # Allow running without explicit app/db args if already in app context
@@ -52,76 +54,77 @@ def process_billing_cycle(app=None, db=None):
 
     with app.app_context():
         now = datetime.utcnow()
-        subscriptions = Subscription.query.filter_by(active=True).all()
-
-        for sub in subscriptions:
-            plan = sub.plan
-            user = sub.user
-
-            # 1️⃣ Disable expired subscriptions
-            if sub.end_at and sub.end_at < now:
-                sub.active = False
-                try:
-                    disable_user_access(user.phone, plan.connection_type)
-                    print(f"[INFO] Disabled expired subscription for {user.phone} ({plan.name})")
-                except Exception as e:
-                    print(f"[ERROR] Failed to disable access for {user.phone}: {e}")
-                continue
-
-            # 2️⃣ Handle pro-rated billing
-            if sub.mid_cycle_plan_change:
-                old_plan = plan
-                new_plan = sub.plan
-                prorated_charge = calculate_prorated_charge(sub, old_plan, new_plan)
-                if prorated_charge > 0:
+        query = Subscription.query.filter_by(active=True)
+
+        for subscriptions in subscription_batches(query, batch_size):
+            invoices = []
+            # expired users are blocked in RADIUS together once the chunk is committed
+            radius = RadiusBatch()
+            expired = {}
+
+            for sub in subscriptions:
+                plan = sub.plan
+                user = sub.user
+
+                # 1️⃣ Disable expired subscriptions
+                if sub.end_at and sub.end_at < now:
+                    sub.active = False
+                    radius.revoke(str(user.phone))
+                    expired[str(user.phone)] = plan.name
+                    continue
+
+                # 2️⃣ Handle pro-rated billing
+                if sub.mid_cycle_plan_change:
+                    old_plan = plan
+                    new_plan = sub.plan
+                    prorated_charge = calculate_prorated_charge(sub, old_plan, new_plan)
+                    if prorated_charge > 0:
+                        invoices.append(Invoice(
+                            user_id=user.id,
+                            subscription_id=sub.id,
+                            kind='plan_change',
+                            amount=prorated_charge,
+                            generated_at=now,
+                            due_date=now + timedelta(days=3),
+                            status='Unpaid'
+                        ))
+                        sub.mid_cycle_plan_change = False
+                        print(f"[INFO] Pro-rated invoice generated for {user.phone}: {prorated_charge} KES")
+
+                # 3️⃣ Generate regular invoices
+                if not sub.last_billed_at or (now - sub.last_billed_at).days >= plan.duration_days:
+                    base_amount = plan.price
+                    extra_charges = calculate_usage_charges(sub)
+                    total_due = base_amount + extra_charges
+
                     invoice = Invoice(
                         user_id=user.id,
                         subscription_id=sub.id,
-                        amount=prorated_charge,
+                        amount=total_due,
                         generated_at=now,
                         due_date=now + timedelta(days=3),
                         status='Unpaid'
                     )
-                    db.session.add(invoice)
-                    sub.mid_cycle_plan_change = False
-                    db.session.commit()
-                    print(f"[INFO] Pro-rated invoice generated for {user.phone}: {prorated_charge} KES")
-
-            # 3️⃣ Generate regular invoices
-            if not sub.last_billed_at or (now - sub.last_billed_at).days >= plan.duration_days:
-                base_amount = plan.price
-                extra_charges = calculate_usage_charges(sub)
-                total_due = base_amount + extra_charges
-
-                invoice = Invoice(
-                    user_id=user.id,
-                    subscription_id=sub.id,
-                    amount=total_due,
-                    generated_at=now,
-                    due_date=now + timedelta(days=3),
-                    status='Unpaid'
-                )
-                db.session.add(invoice)
-
-                sub.last_billed_at = now
-                sub.end_at = now + timedelta(days=plan.duration_days)
-                db.session.commit()
-
-                print(f"[INFO] Invoice created for {user.phone}: {total_due} KES (base: {base_amount}, extra: {extra_charges})")
-
-                # 4️⃣ Attempt auto-renew
-                if sub.auto_renew:
-                    try:
-                        print(f"[INFO] Initiating auto-renew for {user.phone}")
-                        response = mpesa.stk_push(user.phone, total_due, invoice.id)
-                        if response.get("ResponseCode") == "0":
-                            enable_user_access(user.phone, plan.connection_type)
-                            invoice.status = "Paid"
-                            db.session.commit()
-                            print(f"[SUCCESS] Auto-renew successful for {user.phone}")
-                        else:
-                            print(f"[WARN] STK push failed for {user.phone}: {response}")
-                    except Exception as e:
-                        print(f"[ERROR] Auto-renew failed for {user.phone}: {e}")
+                    invoices.append(invoice)
+
+                    sub.last_billed_at = now
+                    sub.end_at = now + timedelta(days=plan.duration_days)
+                    schedule_next_bill(sub)
+
+                    print(f"[INFO] Invoice created for {user.phone}: {total_due} KES (base: {base_amount}, extra: {extra_charges})")
+
+                    # 4️⃣ Queue auto-renew; auto_renew.dispatch_pending_charges sends the STK push
+                    if sub.auto_renew:
+                        queue_auto_renew(sub, invoice, total_due)
+                        print(f"[INFO] Queued auto-renew for {user.phone}")
+
+            db.session.add_all(invoices)
+            db.session.commit()
+
+            for phone, error in radius.flush().items():
+                if error:
+                    print(f"[ERROR] Failed to disable access for {phone}: {error}")
+                else:
+                    print(f"[INFO] Disabled expired subscription for {phone} ({expired[phone]})")
 
         print(f"[DONE] Billing cycle processed at {now}")
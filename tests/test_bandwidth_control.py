@@ -0,0 +1,46 @@
+# test_bandwidth_control.py
+from models import db, User, Plan, AccessChange
+from bandwidth_control import AccessCache, access_decision, access_cache, update_data_usage
+
+
+def test_other_process_cache_drops_changed_user(app):
+    plan = Plan(name='Home', price=1000.0, connection_type='pppoe', data_quota=50.0,
+                download_speed=10, upload_speed=5)
+    db.session.add(plan)
+    db.session.flush()
+    user = User(phone='254700000001', password_hash='x', plan_id=plan.id, is_active=True, data_used=1.0)
+    db.session.add(user)
+    db.session.commit()
+    assert access_decision(user.id).allowed
+
+    # a cache in another process, holding the old decision
+    other = AccessCache()
+    other.sync()
+    other.put(user.id, access_cache.get(user.id))
+
+    logged = AccessChange.query.filter_by(user_id=user.id).count()
+    user.is_active = False
+    db.session.commit()
+    assert AccessChange.query.filter_by(user_id=user.id).count() == logged + 1
+    assert not access_decision(user.id).allowed  # this process: dropped on commit
+
+    other._next_sync = 0
+    other.sync()
+    assert other.get(user.id) is None
+
+
+def test_only_quota_crossing_is_logged(app):
+    plan = Plan(name='Capped', price=500.0, connection_type='hotspot', data_quota=1.0)
+    db.session.add(plan)
+    db.session.flush()
+    user = User(phone='254700000002', password_hash='x', plan_id=plan.id, is_active=True, data_used=0.0)
+    db.session.add(user)
+    db.session.commit()
+    logged = AccessChange.query.filter_by(user_id=user.id).count()
+
+    update_data_usage(user, 512, db)  # half the quota
+    assert AccessChange.query.filter_by(user_id=user.id).count() == logged
+
+    update_data_usage(user, 512, db)  # quota reached: switched off
+    assert not user.is_active
+    assert AccessChange.query.filter_by(user_id=user.id).count() == logged + 1
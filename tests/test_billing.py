@@ -0,0 +1,136 @@
+# test_billing.py
+import json
+from datetime import datetime, timedelta
+
+from models import db, User, Plan, Subscription, Usage, Invoice, BillingRun
+from billing import generate_invoices_for_date, change_subscription_plan, money, BILLING_RUN_LEASE
+
+
+def test_bills_due_subscription_with_usage(app):
+    plan = Plan(name='Data', price=500.0, connection_type='pppoe',
+                billing_cycle='monthly', rate_per_gb=10.0)
+    user = User(phone='254700000001', password_hash='x')
+    db.session.add_all([plan, user])
+    db.session.flush()
+    sub = Subscription(user_id=user.id, plan_id=plan.id, active=True,
+                       start_at=datetime(2025, 1, 1), last_billed_at=datetime(2025, 1, 1))
+    db.session.add(sub)
+    db.session.flush()
+    db.session.add_all([
+        Usage(subscription_id=sub.id, timestamp=datetime(2025, 1, 10), rx_bytes=2 * 1024 ** 3, tx_bytes=0),
+        Usage(subscription_id=sub.id, timestamp=datetime(2025, 1, 20), rx_bytes=0, tx_bytes=1024 ** 3),
+        # next period, not billed yet
+        Usage(subscription_id=sub.id, timestamp=datetime(2025, 2, 1, 12), rx_bytes=5 * 1024 ** 3, tx_bytes=0),
+    ])
+    db.session.commit()
+
+    invoices = generate_invoices_for_date(datetime(2025, 2, 2))
+
+    assert len(invoices) == 1
+    invoice = Invoice.query.one()
+    assert invoice.subscription_id == sub.id
+    assert invoice.period_start == datetime(2025, 1, 1)
+    assert invoice.amount == 530.0
+    details = json.loads(invoice.details)
+    assert details['usage_bytes'] == 3 * 1024 ** 3
+    assert details['usage_charge'] == 30.0
+    assert BillingRun.query.one().status == 'completed'
+
+
+def _monthly_sub(price=300.0):
+    old_plan = Plan(name='Basic', price=price, connection_type='pppoe', billing_cycle='monthly')
+    new_plan = Plan(name='Plus', price=2 * price, connection_type='pppoe', billing_cycle='monthly')
+    user = User(phone='254700000002', password_hash='x')
+    db.session.add_all([old_plan, new_plan, user])
+    db.session.flush()
+    sub = Subscription(user_id=user.id, plan_id=old_plan.id, active=True,
+                       start_at=datetime(2025, 1, 1), last_billed_at=datetime(2025, 1, 1))
+    db.session.add(sub)
+    db.session.commit()
+    return sub, old_plan, new_plan
+
+
+def test_plan_change_rest_of_cycle_billed_on_new_plan(app):
+    sub, old_plan, new_plan = _monthly_sub()
+
+    change_subscription_plan(sub, new_plan, datetime(2025, 1, 16))
+    invoices = generate_invoices_for_date(datetime(2025, 2, 1, 1))
+
+    assert len(invoices) == 1
+    rows = Invoice.query.order_by(Invoice.id).all()
+    assert [(i.kind, i.period_start, i.period_end) for i in rows] == [
+        ('plan_change', datetime(2025, 1, 1), datetime(2025, 1, 16)),
+        ('cycle', datetime(2025, 1, 1), datetime(2025, 2, 1)),
+    ]
+    # 15 of 31 days on the old plan, 16 on the new one
+    assert rows[0].amount == money(300.0 * 15 / 31)
+    assert rows[1].amount == money(600.0 * 16 / 31)
+    assert sub.last_billed_at == datetime(2025, 2, 1)
+
+
+def test_second_plan_change_in_same_cycle(app):
+    sub, old_plan, new_plan = _monthly_sub()
+
+    change_subscription_plan(sub, new_plan, datetime(2025, 1, 16))
+    change_subscription_plan(sub, old_plan, datetime(2025, 1, 20))
+    generate_invoices_for_date(datetime(2025, 2, 1, 1))
+
+    rows = Invoice.query.order_by(Invoice.id).all()
+    assert [(i.kind, i.period_start, i.period_end) for i in rows] == [
+        ('plan_change', datetime(2025, 1, 1), datetime(2025, 1, 16)),
+        ('plan_change', datetime(2025, 1, 16), datetime(2025, 1, 20)),
+        ('cycle', datetime(2025, 1, 1), datetime(2025, 2, 1)),
+    ]
+    assert rows[1].amount == money(600.0 * 4 / 31)
+    assert rows[2].amount == money(300.0 * 12 / 31)
+
+    # rerunning for the same boundary does not bill the cycle again
+    assert generate_invoices_for_date(datetime(2025, 2, 1, 2)) == []
+
+
+def _due_subs(count):
+    plan = Plan(name='Flat', price=100.0, connection_type='pppoe', billing_cycle='monthly')
+    db.session.add(plan)
+    db.session.flush()
+    subs = []
+    for n in range(count):
+        user = User(phone=f'25471000000{n}', password_hash='x')
+        db.session.add(user)
+        db.session.flush()
+        subs.append(Subscription(user_id=user.id, plan_id=plan.id, active=True,
+                                 start_at=datetime(2025, 1, 1), last_billed_at=datetime(2025, 1, 1)))
+    db.session.add_all(subs)
+    db.session.commit()
+    return subs
+
+
+def test_crashed_run_is_resumed_from_its_cursor(app):
+    subs = _due_subs(3)
+    # a run that committed the first subscription, then its process died
+    subs[0].last_billed_at = datetime(2025, 2, 1)
+    db.session.add(Invoice(user_id=subs[0].user_id, subscription_id=subs[0].id, amount=100.0,
+                           period_start=datetime(2025, 1, 1), period_end=datetime(2025, 2, 1)))
+    db.session.add(BillingRun(run_date=datetime(2025, 2, 1, 1), cursor=subs[0].id, status='running',
+                              subscriptions_processed=1, invoices_created=1,
+                              updated_at=datetime.utcnow() - BILLING_RUN_LEASE - timedelta(minutes=1)))
+    db.session.commit()
+
+    resumed = generate_invoices_for_date(datetime(2025, 2, 3), batch_size=1)
+
+    assert [inv.subscription_id for inv in resumed] == [subs[1].id, subs[2].id]
+    assert Invoice.query.count() == 3
+    run = BillingRun.query.one()
+    assert (run.status, run.subscriptions_processed, run.invoices_created) == ('completed', 3, 3)
+    # the run keeps its original run_date
+    assert run.run_date == datetime(2025, 2, 1, 1)
+
+
+def test_live_run_is_not_taken_over(app):
+    _due_subs(2)
+    db.session.add(BillingRun(run_date=datetime(2025, 2, 1), cursor=0, status='running',
+                              subscriptions_processed=0, invoices_created=0, updated_at=datetime.utcnow()))
+    db.session.commit()
+
+    assert generate_invoices_for_date(datetime(2025, 2, 1, 1)) == []
+    assert Invoice.query.count() == 0
+    assert BillingRun.query.count() == 1
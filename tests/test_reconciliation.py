@@ -0,0 +1,109 @@
+# test_reconciliation.py
+from datetime import datetime
+
+import reconciliation
+from models import db, User, Invoice, Transaction
+from reconciliation import reconcile_payments
+
+NOW = datetime(2025, 3, 10, 12)
+
+
+def _user(phone='254700000010'):
+    user = User(phone=phone, password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+
+def _invoice(user, amount, generated_at=datetime(2025, 3, 1)):
+    invoice = Invoice(user_id=user.id, amount=amount, status='Unpaid', generated_at=generated_at)
+    db.session.add(invoice)
+    db.session.flush()
+    return invoice
+
+
+def _payment(user, amount, reference, timestamp=datetime(2025, 3, 10, 9)):
+    txn = Transaction(user_id=user.id, phone=user.phone, amount=amount, status='Completed',
+                      account_reference=reference, timestamp=timestamp)
+    db.session.add(txn)
+    db.session.flush()
+    return txn
+
+
+def test_reference_match_pays_named_invoice(app):
+    user = _user()
+    older, named = _invoice(user, 500), _invoice(user, 500, datetime(2025, 3, 5))
+    txn = _payment(user, 500, f'INV{named.id}')
+    db.session.commit()
+
+    report = reconcile_payments(now=NOW)
+
+    assert (report['matched'], report['matched_by_reference']) == (1, 1)
+    assert db.session.get(Invoice, named.id).status == 'Paid'
+    assert db.session.get(Invoice, older.id).status == 'Unpaid'
+    assert db.session.get(Transaction, txn.id).invoice_id == named.id
+
+
+def test_reference_amount_mismatch_is_not_paid(app):
+    user = _user()
+    invoice = _invoice(user, 500)
+    _payment(user, 200, f'INV{invoice.id}')
+    db.session.commit()
+
+    report = reconcile_payments(now=NOW)
+
+    assert report['matched'] == 0
+    assert [t['reason'] for t in report['unmatched_transactions']] == ['amount mismatch']
+    assert db.session.get(Invoice, invoice.id).status == 'Unpaid'
+
+
+def test_unreferenced_payment_settles_oldest_invoice_of_same_amount(app):
+    user = _user()
+    other_amount = _invoice(user, 300, datetime(2025, 2, 20))
+    oldest, newer = _invoice(user, 500, datetime(2025, 2, 25)), _invoice(user, 500)
+    txn = _payment(user, 500, None)
+    db.session.commit()
+
+    report = reconcile_payments(now=NOW)
+
+    assert (report['matched'], report['matched_by_amount']) == (1, 1)
+    assert db.session.get(Invoice, oldest.id).status == 'Paid'
+    assert db.session.get(Invoice, newer.id).status == 'Unpaid'
+    assert db.session.get(Invoice, other_amount.id).status == 'Unpaid'
+    assert db.session.get(Transaction, txn.id).invoice_id == oldest.id
+
+
+def test_plan_purchase_never_settles_an_invoice(app):
+    user = _user()
+    invoice = _invoice(user, 500)
+    txn = _payment(user, 500, None)
+    txn.account_reference = f'SUB{txn.id}'
+    db.session.commit()
+
+    report = reconcile_payments(now=NOW)
+
+    assert report['transactions'] == 0
+    assert db.session.get(Invoice, invoice.id).status == 'Unpaid'
+    assert db.session.get(Transaction, txn.id).invoice_id is None
+
+
+def test_invoice_settled_meanwhile_is_not_linked(app, monkeypatch):
+    user = _user()
+    invoice = _invoice(user, 500)
+    txn = _payment(user, 500, f'INV{invoice.id}')
+    db.session.commit()
+
+    load_open_invoices = reconciliation._load_open_invoices
+
+    def paid_by_hand_after_loading(*args):
+        invoices = load_open_invoices(*args)
+        Invoice.query.filter_by(id=invoice.id).update({'status': 'Paid'})
+        return invoices
+
+    monkeypatch.setattr(reconciliation, '_load_open_invoices', paid_by_hand_after_loading)
+    report = reconcile_payments(now=NOW)
+
+    assert report['matched'] == 0
+    assert [t['reason'] for t in report['unmatched_transactions']] == ['invoice settled meanwhile']
+    assert db.session.get(Transaction, txn.id).invoice_id is None
+    assert db.session.get(Invoice, invoice.id).paid_at is None
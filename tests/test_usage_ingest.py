@@ -0,0 +1,56 @@
+# test_usage_ingest.py
+from datetime import datetime
+
+import pytest
+
+from models import db, User, Subscription, Usage, UsageHourly
+from usage_ingest import ingest_usage, UsageIngestError
+
+
+def _subscription():
+    db.session.add_all([User(id=1, phone='254700000001', password_hash='x'), Subscription(id=1, user_id=1)])
+    db.session.commit()
+
+
+def test_ingest_accepts_dicts_tuples_and_timestamp_formats(app):
+    _subscription()
+
+    inserted = ingest_usage([
+        {'subscription_id': 1, 'timestamp': '2025-01-01T09:10:00Z', 'rx_bytes': 100, 'tx_bytes': 10},
+        (1, datetime(2025, 1, 1, 9, 20), 200, 20),
+        [1, 1735723200, None, 30],  # epoch seconds: 2025-01-01 09:20 UTC, missing rx counts as 0
+    ])
+
+    assert inserted == 3
+    assert Usage.query.count() == 3
+    hourly = UsageHourly.query.one()
+    assert (hourly.bucket, hourly.rx_bytes, hourly.tx_bytes) == (datetime(2025, 1, 1, 9), 300, 60)
+
+
+@pytest.mark.parametrize('row, error', [
+    ({'timestamp': '2025-01-01T00:00:00', 'rx_bytes': 1}, "'subscription_id'"),
+    ({'subscription_id': 1, 'timestamp': 'yesterday'}, 'Invalid isoformat'),
+    ((1, '2025-01-01T00:00:00', -5, 0), 'byte counters must be >= 0'),
+    ((1, '2025-01-01T00:00:00'), 'not enough values'),
+    ((2, '2025-01-01T00:00:00', 1, 1), 'unknown subscription 2'),
+])
+def test_invalid_row_rejects_the_whole_batch(app, row, error):
+    _subscription()
+    good = (1, '2025-01-01T00:00:00', 1, 1)
+
+    with pytest.raises(UsageIngestError) as excinfo:
+        ingest_usage([good, row])
+
+    assert [e['row'] for e in excinfo.value.errors] == [1]
+    assert error in excinfo.value.errors[0]['error']
+    assert Usage.query.count() == 0
+    assert UsageHourly.query.count() == 0
+
+
+def test_oversized_batch_is_rejected(app, monkeypatch):
+    monkeypatch.setattr('usage_ingest.MAX_INGEST_ROWS', 2)
+    _subscription()
+
+    with pytest.raises(UsageIngestError):
+        ingest_usage([(1, '2025-01-01T00:00:00', 1, 1)] * 3)
+    assert Usage.query.count() == 0
@@ -0,0 +1,24 @@
+# test_usage_poller.py
+from usage_poller import CounterState, Session
+
+
+def _deltas(state, sessions, held=()):
+    out, seen = state.deltas('r1', sessions)
+    state.advance('r1', seen, held)
+    return {key[1]: (rx, tx) for key, rx, tx in out}
+
+
+def test_counter_deltas_resets_and_held_keys():
+    state = CounterState()
+    assert _deltas(state, [Session('hotspot', 'a', '*1', 100, 10)]) == {}  # seeding
+    assert _deltas(state, [Session('hotspot', 'a', '*1', 150, 15),
+                           Session('hotspot', 'b', '*2', 40, 4)]) == {'a': (50, 5), 'b': (40, 4)}
+    # reconnect (new id) and counter reset both count from zero
+    assert _deltas(state, [Session('hotspot', 'a', '*9', 30, 3),
+                           Session('hotspot', 'b', '*2', 7, 1)]) == {'a': (30, 3), 'b': (7, 1)}
+
+    # deltas() alone does not move the counters (e.g. the write failed)
+    state.deltas('r1', [Session('hotspot', 'a', '*9', 80, 8)])
+    # a held key keeps its counters, so its bytes come back on the next poll
+    assert _deltas(state, [Session('hotspot', 'a', '*9', 90, 9)], held={('hotspot', 'a')}) == {'a': (60, 6)}
+    assert _deltas(state, [Session('hotspot', 'a', '*9', 95, 9)]) == {'a': (65, 6)}
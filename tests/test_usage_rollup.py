@@ -0,0 +1,20 @@
+# test_usage_rollup.py
+from datetime import datetime
+
+from models import db, User, Subscription, Usage, UsageHourly, UsageDaily
+
+
+def test_orm_usage_updates_rollups(app):
+    db.session.add_all([User(id=1, phone='254700000001', password_hash='x'), Subscription(id=1, user_id=1)])
+    db.session.flush()
+    db.session.add_all([
+        Usage(subscription_id=1, timestamp=datetime(2025, 1, 1, 9, 15), rx_bytes=100, tx_bytes=10),
+        Usage(subscription_id=1, timestamp=datetime(2025, 1, 1, 9, 45), rx_bytes=200, tx_bytes=20),
+        Usage(subscription_id=1, timestamp=datetime(2025, 1, 1, 17, 0), rx_bytes=300, tx_bytes=30),
+    ])
+    db.session.commit()
+
+    hourly = {(h.bucket, h.rx_bytes, h.tx_bytes) for h in UsageHourly.query}
+    assert hourly == {(datetime(2025, 1, 1, 9), 300, 30), (datetime(2025, 1, 1, 17), 300, 30)}
+    daily = UsageDaily.query.one()
+    assert (daily.bucket, daily.rx_bytes, daily.tx_bytes) == (datetime(2025, 1, 1), 600, 60)
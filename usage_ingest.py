@@ -0,0 +1,91 @@
+# usage_ingest.py
+from datetime import datetime, timezone
+
+from models import db, Usage, Subscription
+from usage_rollup import apply_to_rollups
+
+# largest batch accepted by a single ingest call
+MAX_INGEST_ROWS = 200000
+
+
+class UsageIngestError(ValueError):
+    """Raised when a batch fails validation; nothing from the batch is written."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"{len(errors)} invalid usage rows")
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        ts = value
+    elif isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+    else:
+        ts = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    # stored as naive UTC like every other DateTime column
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _counter(value):
+    value = int(value or 0)
+    if value < 0:
+        raise ValueError("byte counters must be >= 0")
+    return value
+
+
+def validate_usage_rows(rows):
+    """Normalize rows to (subscription_id, timestamp, rx_bytes, tx_bytes) tuples.
+       Each row is a dict with those keys or a 4-item sequence; timestamps may be
+       datetimes, ISO-8601 strings or epoch seconds. Raises UsageIngestError."""
+    if len(rows) > MAX_INGEST_ROWS:
+        raise UsageIngestError([{'row': None, 'error': f"batch larger than {MAX_INGEST_ROWS} rows"}])
+
+    clean, errors = [], []
+    for i, row in enumerate(rows):
+        try:
+            if isinstance(row, dict):
+                sub_id, ts, rx, tx = row['subscription_id'], row['timestamp'], row.get('rx_bytes'), row.get('tx_bytes')
+            else:
+                sub_id, ts, rx, tx = row
+            clean.append((int(sub_id), _timestamp(ts), _counter(rx), _counter(tx)))
+        except (KeyError, TypeError, ValueError, AttributeError, OverflowError) as e:
+            errors.append({'row': i, 'error': str(e) or type(e).__name__})
+
+    if clean and not errors:
+        sub_ids = list({row[0] for row in clean})
+        known = set()
+        # chunked to stay under the bound-parameter limit
+        for start in range(0, len(sub_ids), 5000):
+            chunk = sub_ids[start:start + 5000]
+            known.update(sid for (sid,) in db.session.query(Subscription.id).filter(Subscription.id.in_(chunk)))
+        for i, row in enumerate(clean):
+            if row[0] not in known:
+                errors.append({'row': i, 'error': f"unknown subscription {row[0]}"})
+    if errors:
+        raise UsageIngestError(errors)
+    return clean
+
+
+def ingest_usage(rows, commit=True):
+    """Validate and insert a batch of usage rows with one executemany, updating the
+       hourly/daily rollups in the same transaction. With commit=False the caller
+       commits, so further writes can join the transaction. Returns the number of rows written."""
+    clean = validate_usage_rows(rows)
+    if not clean:
+        return 0
+    try:
+        conn = db.session.connection()
+        conn.execute(Usage.__table__.insert(), [
+            {'subscription_id': sub_id, 'timestamp': ts, 'rx_bytes': rx, 'tx_bytes': tx}
+            for sub_id, ts, rx, tx in clean
+        ])
+        apply_to_rollups(conn, clean)
+        if commit:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(clean)
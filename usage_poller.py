@@ -0,0 +1,216 @@
+# usage_poller.py
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from models import db, User, Plan, Subscription, record_access_changes
+from usage_ingest import ingest_usage
+from bandwidth_control import access_cache
+from network_manager import mikrotik_api_call, default_router
+from router_fleet import registry, run_on_routers
+
+# seconds between polls (scheduler interval)
+USAGE_POLL_SECONDS = int(os.getenv('USAGE_POLL_SECONDS', '60'))
+# seconds a username -> subscription lookup is reused
+SUBSCRIBER_MAP_TTL = float(os.getenv('SUBSCRIBER_MAP_TTL', '300'))
+# ... and a username without an active subscription (its bytes wait until it has one)
+SUBSCRIBER_MISS_TTL = float(os.getenv('SUBSCRIBER_MISS_TTL', '30'))
+
+# one active session's cumulative counters, from the subscriber's point of view
+Session = namedtuple('Session', 'kind username session_id rx_bytes tx_bytes')
+
+
+def fetch_sessions(router):
+    """
+    Counters for a router's active sessions only: hotspot sessions from
+    /ip/hotspot/active and PPPoE sessions from their dynamic pppoe-in interfaces.
+    The router counts bytes-in/rx-byte as received from the client, so those
+    become the subscriber's tx.
+    """
+    sessions = []
+    for entry in mikrotik_api_call("/ip/hotspot/active", router=router,
+                                   params={".proplist": ".id,user,bytes-in,bytes-out"}):
+        if entry.get("user"):
+            sessions.append(Session("hotspot", entry["user"], entry[".id"],
+                                    int(entry.get("bytes-out") or 0), int(entry.get("bytes-in") or 0)))
+    for entry in mikrotik_api_call("/interface", router=router,
+                                   params={"type": "pppoe-in", ".proplist": ".id,name,rx-byte,tx-byte"}):
+        name = entry.get("name") or ""
+        # dynamic interfaces are named <pppoe-USERNAME>
+        if name.startswith("<pppoe-") and name.endswith(">"):
+            sessions.append(Session("pppoe", name[7:-1], entry[".id"],
+                                    int(entry.get("tx-byte") or 0), int(entry.get("rx-byte") or 0)))
+    return sessions
+
+
+class CounterState:
+    """
+    Last committed cumulative counters per router and (kind, username), turned into deltas:
+      - first poll of a router only seeds the state (its history is unknown)
+      - a session seen for the first time later counts from zero
+      - a new session id for the same user (reconnect) starts over from zero
+      - a counter lower than last time (reset/wrap) counts from zero
+    deltas() does not change anything; advance() moves the counters forward once
+    the deltas are safely written, so a failed write is simply retried next poll.
+    Bytes a session moved between its last poll and disconnecting are not seen.
+    """
+
+    def __init__(self):
+        self._last = {}  # router name -> {(kind, username): (session_id, rx, tx)}
+
+    def deltas(self, router_name, sessions):
+        """([((kind, username), rx_delta, tx_delta)], counters seen) since the last
+           committed poll of this router."""
+        previous_all = self._last.get(router_name)
+        seen, out = {}, []
+        for s in sessions:
+            key = (s.kind, s.username)
+            seen[key] = (s.session_id, s.rx_bytes, s.tx_bytes)
+            if previous_all is None:
+                continue
+            previous = previous_all.get(key)
+            if previous is None or previous[0] != s.session_id:
+                rx, tx = s.rx_bytes, s.tx_bytes
+            else:
+                rx = s.rx_bytes - previous[1] if s.rx_bytes >= previous[1] else s.rx_bytes
+                tx = s.tx_bytes - previous[2] if s.tx_bytes >= previous[2] else s.tx_bytes
+            if rx or tx:
+                out.append((key, rx, tx))
+        return out, seen
+
+    def advance(self, router_name, seen, held=()):
+        """Commit the counters from deltas(). Keys in held keep their previous
+           counters, so their delta is produced again on the next poll."""
+        previous = self._last.get(router_name, {})
+        counters = dict(seen)
+        for key in held:
+            if key in previous:
+                counters[key] = previous[key]
+            else:
+                counters.pop(key, None)
+        # sessions that ended are not carried over, so per-poll work tracks active sessions
+        self._last[router_name] = counters
+
+    def forget(self, router_name):
+        """Drop a router's state (e.g. after it rebooted) so its next poll re-seeds."""
+        self._last.pop(router_name, None)
+
+
+class SubscriberMap:
+    """username (phone) -> (subscription_id, user_id) of the active subscription, cached."""
+
+    def __init__(self, ttl=SUBSCRIBER_MAP_TTL, miss_ttl=SUBSCRIBER_MISS_TTL):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._entries = {}  # username -> (expires_at, (subscription_id, user_id) or None)
+
+    def resolve(self, usernames):
+        now = time.monotonic()
+        missing = [u for u in set(usernames) if self._entries.get(u, (0,))[0] < now]
+        for start in range(0, len(missing), 5000):
+            chunk = missing[start:start + 5000]
+            found = {phone: (sub_id, user_id) for phone, sub_id, user_id in
+                     db.session.query(User.phone, Subscription.id, User.id)
+                     .join(Subscription, Subscription.user_id == User.id)
+                     .filter(User.phone.in_(chunk), Subscription.active.is_(True))
+                     .order_by(Subscription.id)}
+            for username in chunk:
+                match = found.get(username)
+                self._entries[username] = (now + (self.ttl if match else self.miss_ttl), match)
+        return {u: self._entries[u][1] for u in usernames if self._entries[u][1]}
+
+
+_state = CounterState()
+_subscribers = SubscriberMap()
+
+
+def _apply_data_used(gb_by_user):
+    """Add GB to User.data_used in one executemany and switch off users who crossed
+       their quota. Returns the ids of the users switched off."""
+    user_table = User.__table__
+    conn = db.session.connection()
+    conn.execute(
+        user_table.update()
+        .where(user_table.c.id == db.bindparam('uid'))
+        .values(data_used=db.func.coalesce(user_table.c.data_used, 0.0) + db.bindparam('gb')),
+        [{'uid': uid, 'gb': gb} for uid, gb in gb_by_user.items()]
+    )
+    quota = (db.select(Plan.data_quota)
+             .where(Plan.id == user_table.c.plan_id)
+             .scalar_subquery())
+    ids, switched_off = list(gb_by_user), []
+    for start in range(0, len(ids), 5000):
+        over_quota = [uid for (uid,) in conn.execute(
+            db.select(user_table.c.id)
+            .where(user_table.c.id.in_(ids[start:start + 5000]),
+                   user_table.c.is_active.is_(True),
+                   quota.isnot(None),
+                   user_table.c.data_used >= quota)
+        )]
+        if over_quota:
+            conn.execute(user_table.update().where(user_table.c.id.in_(over_quota)).values(is_active=False))
+            switched_off.extend(over_quota)
+    return switched_off
+
+
+def poll_usage(routers=None, max_workers=None, now=None):
+    """
+    One poll: read active-session counters from every router concurrently,
+    convert them to deltas, write them as Usage rows through ingest_usage and
+    add them to User.data_used, all in one transaction. Counters only advance
+    after that commit; deltas of usernames without an active subscription are
+    held back until they have one. Users cut off at their quota are logged as
+    access changes for every process. Must run inside an app context.
+    Returns a summary dict.
+    """
+    started = time.monotonic()
+    routers = routers or registry.routers() or [default_router()]
+    now = now or datetime.utcnow()
+    summary = {'routers': len(routers), 'sessions': 0, 'rows': 0, 'unmatched': 0, 'errors': {}}
+
+    polled = []  # (router name, deltas, counters seen)
+    # two filtered GETs per router, all routers at once
+    for (router, _, _), sessions, error in run_on_routers(
+            [(router, fetch_sessions, ()) for router in routers], max_workers):
+        if error:
+            summary['errors'][router.name] = error
+            continue
+        summary['sessions'] += len(sessions)
+        polled.append((router.name, *_state.deltas(router.name, sessions)))
+
+    held = {name: set() for name, _, _ in polled}
+    usernames = [username for _, deltas, _ in polled for (_, username), _, _ in deltas]
+    if usernames:
+        subscribers = _subscribers.resolve(usernames)
+        rows, gb_by_user = [], {}
+        for name, deltas, _ in polled:
+            for key, rx, tx in deltas:
+                match = subscribers.get(key[1])
+                if match is None:
+                    summary['unmatched'] += 1
+                    held[name].add(key)
+                    continue
+                sub_id, user_id = match
+                rows.append((sub_id, now, rx, tx))
+                gb_by_user[user_id] = gb_by_user.get(user_id, 0.0) + (rx + tx) / 1024 ** 3
+        try:
+            summary['rows'] = ingest_usage(rows, commit=False)
+            if gb_by_user:
+                # every process's cache must stop allowing users cut off here
+                record_access_changes(db.session, _apply_data_used(gb_by_user))
+            db.session.commit()
+        except Exception:
+            # counters were not advanced, so the next poll writes these bytes again
+            db.session.rollback()
+            raise
+        # remaining quota changed for the rest; only this process's cache is refreshed
+        access_cache.invalidate(*gb_by_user)
+
+    for name, _, seen in polled:
+        _state.advance(name, seen, held[name])
+
+    summary['seconds'] = round(time.monotonic() - started, 2)
+    print(f"[DONE] Usage poll: {summary['rows']} rows from {summary['sessions']} sessions on "
+          f"{summary['routers']} routers ({len(summary['errors'])} failed) in {summary['seconds']}s")
+    return summary
@@ -0,0 +1,89 @@
+# usage_retention.py
+import os
+import time
+from datetime import datetime, timedelta
+
+from models import db, Usage
+from usage_rollup import day_bucket
+
+# raw Usage rows newer than this are left untouched
+USAGE_RAW_RETENTION_DAYS = int(os.getenv('USAGE_RAW_RETENTION_DAYS', '30'))
+# subscriptions compacted per transaction; bounds how long each write lock is held
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '200'))
+
+
+def _next_day_with_rows(after, cutoff: datetime):
+    q = db.session.query(db.func.min(Usage.timestamp)).filter(Usage.timestamp < cutoff)
+    if after is not None:
+        q = q.filter(Usage.timestamp >= after)
+    oldest = q.scalar()
+    return day_bucket(oldest) if oldest else None
+
+
+def _compact_day(day: datetime, batch_size: int, pause: float):
+    """Replace each subscription's raw rows for one day with a single row holding
+       the exact rx/tx totals, batch_size subscriptions per transaction."""
+    next_day = day + timedelta(days=1)
+    in_day = (Usage.timestamp >= day, Usage.timestamp < next_day)
+
+    # subscriptions with more than one row that day (already-compacted days are skipped)
+    sub_ids = [sid for (sid,) in db.session.query(Usage.subscription_id)
+               .filter(*in_day, Usage.subscription_id.isnot(None))
+               .group_by(Usage.subscription_id)
+               .having(db.func.count(Usage.id) > 1)
+               .order_by(Usage.subscription_id)]
+    db.session.commit()
+
+    removed = written = 0
+    for start in range(0, len(sub_ids), batch_size):
+        chunk = sub_ids[start:start + batch_size]
+        try:
+            totals = (db.session.query(
+                        Usage.subscription_id,
+                        db.func.sum(db.func.coalesce(Usage.rx_bytes, 0)),
+                        db.func.sum(db.func.coalesce(Usage.tx_bytes, 0)))
+                      .filter(*in_day, Usage.subscription_id.in_(chunk))
+                      .group_by(Usage.subscription_id)
+                      .all())
+            removed += (Usage.query
+                        .filter(*in_day, Usage.subscription_id.in_(chunk))
+                        .delete(synchronize_session=False))
+            db.session.connection().execute(Usage.__table__.insert(), [
+                {'subscription_id': sid, 'timestamp': day, 'rx_bytes': int(rx), 'tx_bytes': int(tx)}
+                for sid, rx, tx in totals
+            ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        written += len(totals)
+        if pause:
+            time.sleep(pause)
+    return removed, written
+
+
+def compact_usage(now: datetime=None, retention_days: int=None, batch_size: int=None, pause: float=0.05):
+    """
+    Downsample raw Usage rows older than retention_days into one row per
+    subscription per day (timestamped at midnight). Totals are preserved
+    exactly, so billing and the rollups give the same answers afterwards.
+    Work is committed in small batches with an optional pause between them
+    so the live database is never write-locked for long. Safe to re-run.
+    """
+    now = now or datetime.utcnow()
+    retention_days = USAGE_RAW_RETENTION_DAYS if retention_days is None else retention_days
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    cutoff = day_bucket(now - timedelta(days=retention_days))
+    summary = {'days': 0, 'rows_removed': 0, 'rows_written': 0}
+
+    day = _next_day_with_rows(None, cutoff)
+    while day is not None:
+        removed, written = _compact_day(day, batch_size, pause)
+        summary['days'] += 1
+        summary['rows_removed'] += removed
+        summary['rows_written'] += written
+        day = _next_day_with_rows(day + timedelta(days=1), cutoff)
+
+    print(f"[DONE] Usage retention: {summary['rows_removed']} raw rows compacted into "
+          f"{summary['rows_written']} daily rows over {summary['days']} days (cutoff {cutoff})")
+    return summary
@@ -0,0 +1,158 @@
+# usage_rollup.py
+import os
+from datetime import datetime, timedelta
+
+from models import db, Usage, UsageHourly, UsageDaily
+
+# read billing/reporting totals from the rollup tables when a period lines up with their buckets
+USE_USAGE_ROLLUPS = os.getenv('USE_USAGE_ROLLUPS', '1') == '1'
+
+
+# ---- Buckets ----
+def hour_bucket(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def day_bucket(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+ROLLUPS = ((UsageHourly, hour_bucket), (UsageDaily, day_bucket))
+
+
+# ---- Incremental maintenance ----
+def _upsert_statement(conn, model):
+    """INSERT ... that adds rx/tx onto an existing (subscription_id, bucket) row."""
+    table = model.__table__
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update(
+            rx_bytes=table.c.rx_bytes + stmt.inserted.rx_bytes,
+            tx_bytes=table.c.tx_bytes + stmt.inserted.tx_bytes,
+        )
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=['subscription_id', 'bucket'],
+        set_={
+            'rx_bytes': table.c.rx_bytes + stmt.excluded.rx_bytes,
+            'tx_bytes': table.c.tx_bytes + stmt.excluded.tx_bytes,
+        },
+    )
+
+def apply_to_rollups(conn, rows):
+    """Add usage rows (subscription_id, timestamp, rx_bytes, tx_bytes) onto the hourly
+       and daily rollups using conn, i.e. inside the caller's transaction.
+       Rows are summed per bucket first, so each rollup gets one executemany.
+       Usage rows flushed through the ORM are passed here by a listener in models.py."""
+    for model, bucket_of in ROLLUPS:
+        sums = {}
+        for sub_id, ts, rx, tx in rows:
+            key = (sub_id, bucket_of(ts))
+            total = sums.get(key)
+            if total is None:
+                sums[key] = [rx or 0, tx or 0]
+            else:
+                total[0] += rx or 0
+                total[1] += tx or 0
+        if sums:
+            conn.execute(_upsert_statement(conn, model), [
+                {'subscription_id': sub_id, 'bucket': bucket, 'rx_bytes': rx, 'tx_bytes': tx}
+                for (sub_id, bucket), (rx, tx) in sums.items()
+            ])
+
+
+# ---- Backfill ----
+def backfill_rollups(start: datetime=None, end: datetime=None, batch_size: int=50000):
+    """Rebuild the rollups from raw Usage rows for whole days in [start, end).
+       Existing rollup buckets in the range are replaced. Must run inside an app context.
+       Returns the number of raw rows read."""
+    start = day_bucket(start) if start else None
+    end = day_bucket(end) + timedelta(days=1) if end and end != day_bucket(end) else end
+
+    for model, _ in ROLLUPS:
+        q = model.query
+        if start:
+            q = q.filter(model.bucket >= start)
+        if end:
+            q = q.filter(model.bucket < end)
+        q.delete(synchronize_session=False)
+    db.session.commit()
+
+    base = db.session.query(Usage.id, Usage.subscription_id, Usage.timestamp, Usage.rx_bytes, Usage.tx_bytes)
+    if start:
+        base = base.filter(Usage.timestamp >= start)
+    if end:
+        base = base.filter(Usage.timestamp < end)
+
+    last_id, total = 0, 0
+    while True:
+        batch = base.filter(Usage.id > last_id).order_by(Usage.id).limit(batch_size).all()
+        if not batch:
+            break
+        apply_to_rollups(db.session.connection(), [
+            (sub_id, ts, rx, tx) for _, sub_id, ts, rx, tx in batch if sub_id is not None
+        ])
+        db.session.commit()
+        last_id = batch[-1][0]
+        total += len(batch)
+        print(f"[INFO] Rolled up {total} usage rows")
+    return total
+
+
+# ---- Reads ----
+def rollup_totals(period_start: datetime, period_end: datetime, subscription_ids=None):
+    """Return {subscription_id: rx+tx bytes} from the coarsest rollup whose buckets
+       tile [period_start, period_end) exactly, or None when the period isn't aligned."""
+    if not USE_USAGE_ROLLUPS:
+        return None
+    period_start, period_end = period_start.replace(tzinfo=None), period_end.replace(tzinfo=None)
+    if day_bucket(period_start) == period_start and day_bucket(period_end) == period_end:
+        model = UsageDaily
+    elif hour_bucket(period_start) == period_start and hour_bucket(period_end) == period_end:
+        model = UsageHourly
+    else:
+        return None
+
+    total = db.func.sum(db.func.coalesce(model.rx_bytes, 0) + db.func.coalesce(model.tx_bytes, 0))
+    q = db.session.query(model.subscription_id, total).filter(
+        model.bucket >= period_start,
+        model.bucket < period_end
+    )
+    if subscription_ids is not None:
+        q = q.filter(model.subscription_id.in_(subscription_ids))
+    return {sub_id: int(total_bytes or 0) for sub_id, total_bytes in q.group_by(model.subscription_id)}
+
+def usage_series(subscription_id: int, start: datetime, end: datetime, granularity: str='daily'):
+    """Return [(bucket, rx_bytes, tx_bytes)] for one subscription from the hourly or daily rollup."""
+    model = UsageHourly if granularity == 'hourly' else UsageDaily
+    rows = (db.session.query(model.bucket, model.rx_bytes, model.tx_bytes)
+            .filter(model.subscription_id == subscription_id,
+                    model.bucket >= start,
+                    model.bucket < end)
+            .order_by(model.bucket))
+    return [(bucket, rx or 0, tx or 0) for bucket, rx, tx in rows]
+
+
+if __name__ == '__main__':
+    import argparse
+    from schedular import create_app
+
+    parser = argparse.ArgumentParser(description="Rebuild hourly/daily usage rollups from raw Usage rows")
+    parser.add_argument('--start', help="first day to rebuild (YYYY-MM-DD), default: beginning")
+    parser.add_argument('--end', help="day to stop before (YYYY-MM-DD), default: now")
+    parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        rows = backfill_rollups(
+            datetime.strptime(args.start, '%Y-%m-%d') if args.start else None,
+            datetime.strptime(args.end, '%Y-%m-%d') if args.end else None,
+            batch_size=args.batch_size,
+        )
+        print(f"Backfilled rollups from {rows} usage rows")